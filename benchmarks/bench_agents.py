@@ -0,0 +1,150 @@
+"""
+End-to-end load benchmark of netvendtk agents against an in-process MockServer.
+
+Reports p50/p99 latency, commands/sec and CPU per command for each agent mode:
+* transmit: AgentBasic.transmit_batches with a post batch and a query batch
+* work: ServiceAgent.work serving a backlog of queued calls
+* call: ServiceAgent.call round trips, served by a worker thread
+
+CPU time is for the whole process, so it includes the mock server's share.
+
+    python benchmarks/bench_agents.py [--iterations N] [--batch-size N] [--json results.json]
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import netvendtk
+import mockserver
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def summarize(mode, latencies, commands, wall, cpu):
+    return {"mode": mode,
+            "iterations": len(latencies),
+            "commands": commands,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "commands_per_sec": commands / wall,
+            "cpu_ms_per_command": cpu * 1000 / commands}
+
+
+def bench_transmit(server, iterations, batch_size):
+    agent = netvendtk.AgentBasic("bench transmit", url=server.url)
+    query = "SELECT MAX(post_id) FROM posts"
+    latencies = []
+    wall_start, cpu_start = time.time(), cpu_time()
+    for i in range(iterations):
+        start = time.time()
+        agent.add_post_batch(["bench post " + str(i) + ":" + str(j) for j in range(batch_size)])
+        agent.add_query_batch([query])
+        agent.transmit_batches()
+        latencies.append(time.time() - start)
+    return summarize("transmit", latencies, iterations * (batch_size + 1),
+                     time.time() - wall_start, cpu_time() - cpu_start)
+
+
+def bench_work(server, iterations, batch_size):
+    service = netvendtk.ServiceAgent("bench work service", url=server.url)
+    service.register_service("echo", lambda *args: list(args), 1)
+    client = netvendtk.ServiceAgent("bench work client", url=server.url)
+
+    latencies = []
+    served = 0
+    wall, cpu = 0.0, 0.0
+    for i in range(iterations):
+        # Queue batch_size calls without waiting for replies
+        for j in range(batch_size):
+            client.call(service.address, "echo", [i, j], 1, wait_for_response=False)
+
+        wall_start, cpu_start = time.time(), cpu_time()
+        service.work()
+        latencies.append(time.time() - wall_start)
+        wall += time.time() - wall_start
+        cpu += cpu_time() - cpu_start
+        served += batch_size
+    return summarize("work", latencies, served, wall, cpu)
+
+
+def bench_call(server, iterations):
+    service = netvendtk.ServiceAgent("bench call service", url=server.url)
+    service.register_service("echo", lambda *args: list(args), 1)
+    client = netvendtk.ServiceAgent("bench call client", url=server.url)
+
+    stopped = threading.Event()
+
+    def serve():
+        while not stopped.is_set():
+            service.work()
+            time.sleep(0.01)
+
+    worker = threading.Thread(target=serve)
+    worker.daemon = True
+    worker.start()
+
+    latencies = []
+    wall_start, cpu_start = time.time(), cpu_time()
+    try:
+        for i in range(iterations):
+            start = time.time()
+            client.call(service.address, "echo", [i], 1, timeout=60)
+            latencies.append(time.time() - start)
+    finally:
+        stopped.set()
+        worker.join()
+    return summarize("call", latencies, iterations, time.time() - wall_start, cpu_time() - cpu_start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--modes", default="transmit,work,call")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    server = mockserver.MockServer(initial_balance=10 ** 15).start()
+    results = []
+    try:
+        for mode in args.modes.split(","):
+            if mode == "transmit":
+                results.append(bench_transmit(server, args.iterations, args.batch_size))
+            elif mode == "work":
+                results.append(bench_work(server, args.iterations, args.batch_size))
+            elif mode == "call":
+                results.append(bench_call(server, args.iterations))
+            else:
+                parser.error("unknown mode " + mode)
+    finally:
+        server.stop()
+
+    sys.stdout.write("{0:<10}{1:>8}{2:>10}{3:>12}{4:>12}{5:>14}{6:>14}\n".format(
+        "mode", "iters", "commands", "p50 ms", "p99 ms", "commands/s", "cpu ms/cmd"))
+    for result in results:
+        sys.stdout.write("{mode:<10}{iterations:>8}{commands:>10}{p50_ms:>12.2f}{p99_ms:>12.2f}"
+                         "{commands_per_sec:>14.2f}{cpu_ms_per_command:>14.2f}\n".format(**result))
+    server_stats = dict(server.stats)
+    sys.stdout.write("server: " + json.dumps(server_stats, sort_keys=True) + "\n")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results, "server": server_stats}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
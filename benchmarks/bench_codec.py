@@ -0,0 +1,70 @@
+"""
+Encode/decode cost versus bytes saved for each payloadcodec codec.
+
+For a few representative call/return payloads, reports the encoded size, the
+saving against plain JSON and the encode and decode time per payload.
+
+    python benchmarks/bench_codec.py [--repeat N] [--json results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloadcodec
+
+
+def sample_payloads():
+    rng = random.Random(0)
+    words = ["netvend", "pulse", "post", "query", "service", "address", "value", "result", "batch", "agent"]
+    return [
+        ("small call", ["echo", [1, "x"]]),
+        ("int list", ["sum", [[rng.randrange(10 ** 6) for _ in range(500)]]]),
+        ("records", [{"id": i, "name": rng.choice(words) + str(i), "tags": rng.sample(words, 3), "score": i * 0.5}
+                     for i in range(200)]),
+        ("text", {"text": " ".join(rng.choice(words) for _ in range(2000))}),
+    ]
+
+
+def timed(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        result = func()
+    return (time.time() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for name, payload in sample_payloads():
+        json_size = len(payloadcodec.encode_payload(payload))
+        for codec in payloadcodec.supported_codecs():
+            encode_time, encoded = timed(lambda: payloadcodec.encode_payload(payload, codec), args.repeat)
+            decode_time, decoded = timed(lambda: payloadcodec.decode_payload(encoded), args.repeat)
+            assert json.dumps(decoded, sort_keys=True) == json.dumps(payload, sort_keys=True)
+            results.append({"payload": name, "codec": codec, "used": payloadcodec.payload_codec(encoded),
+                            "bytes": len(encoded), "saved_pct": 100.0 * (json_size - len(encoded)) / json_size,
+                            "encode_us": encode_time * 1000000, "decode_us": decode_time * 1000000})
+
+    sys.stdout.write("{0:<12}{1:>6}{2:>6}{3:>10}{4:>10}{5:>12}{6:>12}\n".format(
+        "payload", "codec", "used", "bytes", "saved %", "encode us", "decode us"))
+    for result in results:
+        sys.stdout.write("{payload:<12}{codec:>6}{used:>6}{bytes:>10}{saved_pct:>10.1f}"
+                         "{encode_us:>12.1f}{decode_us:>12.1f}\n".format(**result))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Micro-benchmarks of the pybitcointools primitives netvendtk depends on.
+
+Every primitive runs on fixed inputs. For each one the suite records ops/sec, the
+net number of GC-tracked objects left allocated per op (Python 2 has no tracemalloc,
+so this catches leaks and cache growth rather than transient allocations) and a
+digest of the outputs. Results are compared to a stored baseline: any output
+change is a failure. With --check-speed, so is a drop in ops/sec beyond the
+tolerance. Rates are compared relative to a fixed pure-Python calibration
+workload, measured with the baseline and on every run, so a uniformly slower
+machine doesn't read as a regression.
+
+    python benchmarks/bench_pybitcointools.py [--check-speed] [--output results.json]
+    python benchmarks/bench_pybitcointools.py --save-baseline
+
+Exits with status 1 if an output change (or, with --check-speed, a slowdown) is found.
+"""
+
+import os
+import sys
+import gc
+import time
+import json
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pybitcointools
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_pybitcointools.json")
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_MIN_TIME = 0.5
+DEFAULT_ROUNDS = 3
+
+PRIV = "80cbf48697e85b53ddc359a1db625bccf0d5f52e1cdeab0b27ee56086f1314c0"
+PUB = pybitcointools.privtopub(PRIV)
+MSG = "netvend benchmark message"
+SIG = "GziVrg9Qjri7jdgOYAs4WqTadwnNb1ckBXt84L/YgkuqegQTiNzVGz/3p/l2Z876GOs0WhdXcjN7bJrQah2bQcY="
+HASH160 = pybitcointools.bin_hash160(PUB.decode('hex'))
+ADDRESS = pybitcointools.bin_to_b58check(HASH160)
+NUMBER = pybitcointools.decode(PRIV, 16)
+
+# (name, function of no arguments, function turning its output into what is compared against the baseline).
+# ecdsa_sign uses random nonces, so its output is compared by verifying it.
+PRIMITIVES = [
+    ("ecdsa_sign", lambda: pybitcointools.ecdsa_sign(MSG, PRIV), lambda sig: pybitcointools.ecdsa_verify(MSG, sig, PUB)),
+    ("ecdsa_verify", lambda: pybitcointools.ecdsa_verify(MSG, SIG, PUB), None),
+    ("ecdsa_recover", lambda: pybitcointools.ecdsa_recover(MSG, SIG), None),
+    ("privtopub", lambda: pybitcointools.privtopub(PRIV), None),
+    ("bin_to_b58check", lambda: pybitcointools.bin_to_b58check(HASH160), None),
+    ("b58check_to_bin", lambda: pybitcointools.b58check_to_bin(ADDRESS), None),
+    ("encode", lambda: pybitcointools.encode(NUMBER, 58), None),
+    ("decode", lambda: pybitcointools.decode(PRIV, 16), None),
+    ("slowsha", lambda: pybitcointools.slowsha(MSG), None),
+]
+
+
+CALIBRATION = "_calibration"
+
+
+def calibration_workload():
+    """Big-int arithmetic, hashing and string work, in the proportions the primitives use them."""
+    n = NUMBER
+    for i in range(200):
+        n = (n * n + i) % pybitcointools.P
+    digest = hashlib.sha256(str(n)).hexdigest()
+    return "".join(reversed(digest)).encode("hex")
+
+
+def output_digest(func, normalize):
+    output = func()
+    if normalize is not None:
+        output = normalize(output)
+    return hashlib.sha256(repr(output)).hexdigest()
+
+
+def measure(func, min_time, rounds):
+    """Runs func repeatedly for at least min_time seconds per round.
+
+    :return: tuple of the best round's ops/sec and net GC-tracked objects allocated per op
+    """
+    func()
+    best_ops_per_sec = 0.0
+    ops = 0
+    allocs = 0
+    for _ in range(rounds):
+        gc.collect()
+        gc.disable()
+        try:
+            round_ops = 0
+            start = time.time()
+            elapsed = 0.0
+            while elapsed < min_time:
+                count_before = gc.get_count()[0]
+                func()
+                allocs += gc.get_count()[0] - count_before
+                round_ops += 1
+                elapsed = time.time() - start
+        finally:
+            gc.enable()
+        best_ops_per_sec = max(best_ops_per_sec, round_ops / elapsed)
+        ops += round_ops
+    return best_ops_per_sec, float(allocs) / ops
+
+
+def run(names, min_time, rounds):
+    results = {}
+    for name, func, normalize in PRIMITIVES:
+        if names and name not in names:
+            continue
+        ops_per_sec, allocs_per_op = measure(func, min_time, rounds)
+        results[name] = {"ops_per_sec": ops_per_sec,
+                         "allocs_per_op": allocs_per_op,
+                         "output_sha256": output_digest(func, normalize)}
+    return results
+
+
+def compare(results, baseline, tolerance, calibration, check_speed):
+    """Returns a list of regressions of results against baseline.
+
+    :param calibration: calibration ops/sec of this run; baseline rates are scaled by it
+    :param check_speed: also flag slowdowns, not just output changes
+    """
+    problems = []
+    scale = None
+    if CALIBRATION in baseline:
+        scale = calibration / baseline[CALIBRATION]["ops_per_sec"]
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result["output_sha256"] != expected["output_sha256"]:
+            problems.append("{0}: output changed".format(name))
+        if not check_speed:
+            continue
+        if scale is None:
+            problems.append("{0}: baseline has no calibration, save it again to check speed".format(name))
+        elif result["ops_per_sec"] < expected["ops_per_sec"] * scale * (1 - tolerance):
+            problems.append("{0}: {1:.1f} ops/sec, calibrated baseline {2:.1f}".format(
+                name, result["ops_per_sec"], expected["ops_per_sec"] * scale))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--output", help="write results to this file as JSON")
+    parser.add_argument("--check-speed", action="store_true", help="also fail on slowdowns, not just output changes")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed fractional drop in ops/sec before flagging a regression")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME, help="seconds per round")
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS, help="rounds per primitive, the best one counts")
+    parser.add_argument("primitives", nargs="*", help="only run these primitives")
+    args = parser.parse_args()
+
+    results = run(args.primitives, args.min_time, args.rounds)
+    calibration = measure(calibration_workload, args.min_time, args.rounds)[0]
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    scale = 1.0
+    if CALIBRATION in baseline:
+        scale = calibration / baseline[CALIBRATION]["ops_per_sec"]
+    sys.stdout.write("calibration {0:.1f} ops/sec, {1:.2f}x the baseline machine\n".format(calibration, scale))
+    sys.stdout.write("{0:<18}{1:>14}{2:>14}{3:>14}\n".format("primitive", "ops/sec", "baseline", "allocs/op"))
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name, {}).get("ops_per_sec")
+        if expected is not None:
+            expected *= scale
+        sys.stdout.write("{0:<18}{1:>14.1f}{2:>14}{3:>14.1f}\n".format(
+            name, result["ops_per_sec"], "-" if expected is None else "{0:.1f}".format(expected),
+            result["allocs_per_op"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        baseline.update(results)
+        baseline[CALIBRATION] = {"ops_per_sec": calibration}
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return 0
+
+    problems = compare(results, baseline, args.tolerance, calibration, args.check_speed)
+    for problem in problems:
+        sys.stdout.write("REGRESSION " + problem + "\n")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Unit conversion of pulse value columns: per-value loops versus convert_values.
+
+Converts the value column of generated pulse rows with the float math.pow loop
+netvendtk used before exact conversion, with convert_value per value, and with
+convert_values on the whole column. Columns are ints, or digit strings as query
+rows return them. Reports values/sec for each, and how many results of the float
+loop differ from the exact ones.
+
+    python benchmarks/bench_units.py [--rows N] [--json results.json]
+"""
+
+import os
+import sys
+import math
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import netvendtk
+
+# from_unit, to_unit, value range in from_unit, multiple of, column type
+SCENARIOS = [
+    ("sat", "usat", 10 ** 12, 1, int),
+    ("usat", "msat", 10 ** 17, 1000, int),
+    ("usat", "btc", 10 ** 17, 1, int),
+    ("usat", "msat", 10 ** 17, 1000, str),
+]
+
+
+def float_convert_value(amount, from_unit, to_unit="base"):
+    """convert_value as it was, with float math.pow."""
+    result = amount * math.pow(10, netvendtk.unit_pow(from_unit) - netvendtk.unit_pow(to_unit))
+    if result.is_integer():
+        return int(result)
+    return result
+
+
+def make_rows(count, high, multiple, column_type, rng):
+    return [[pulse_id, "1From", "1To", column_type(rng.randrange(high // multiple) * multiple), None]
+            for pulse_id in range(1, count + 1)]
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    results = []
+    for from_unit, to_unit, high, multiple, column_type in SCENARIOS:
+        rows = make_rows(args.rows, high, multiple, column_type, rng)
+        float_time, float_values = timed(lambda: [float_convert_value(int(row[3]), from_unit, to_unit) for row in rows])
+        exact_time, exact_values = timed(lambda: [netvendtk.convert_value(row[3], from_unit, to_unit) for row in rows])
+        column_time, column_values = timed(lambda: netvendtk.convert_values([row[3] for row in rows], from_unit, to_unit))
+        assert list(column_values) == exact_values
+        results.append({"conversion": from_unit + "->" + to_unit, "column": column_type.__name__, "rows": args.rows,
+                        "float_per_sec": args.rows / float_time, "exact_per_sec": args.rows / exact_time,
+                        "column_per_sec": args.rows / column_time, "column_type": type(column_values).__name__,
+                        "float_inexact": sum(1 for a, b in zip(float_values, exact_values) if a != b)})
+
+    sys.stdout.write("numpy: {0}\n".format("yes" if netvendtk.load_numpy() is not None else "no"))
+    sys.stdout.write("{0:<12}{1:<8}{2:>14}{3:>14}{4:>14}{5:>10}{6:>15}\n".format(
+        "conversion", "column", "float/s", "exact/s", "column/s", "speedup", "float inexact"))
+    for result in results:
+        sys.stdout.write("{conversion:<12}{column:<8}{float_per_sec:>14.0f}{exact_per_sec:>14.0f}{column_per_sec:>14.0f}"
+                         "{0:>9.1f}x{float_inexact:>15}\n".format(result["column_per_sec"] / result["float_per_sec"],
+                                                                  **result))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+chunkstore - Content-addressed chunks for large netvend variables.
+
+A chunked variable is split into content-defined chunks (boundaries come from a
+rolling hash of the data, so an edit only changes the chunks around it), each
+posted once under its sha256, plus a small manifest listing the chunk hashes.
+Rewriting a variable after a small change only posts the changed chunks.
+
+Fetched chunks are verified against their hash and kept in a ChunkCache.
+"""
+
+import os
+import json
+import Queue
+import hashlib
+import threading
+import collections
+
+CHUNK_PREFIX = "v:chunk:"
+MANIFEST_PREFIX = "v:jsonc:"
+MANIFEST_VERSION = 1
+
+DEFAULT_MIN_CHUNK_SIZE = 1024
+DEFAULT_AVG_CHUNK_SIZE = 4096
+DEFAULT_MAX_CHUNK_SIZE = 16384
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_CHUNKS_PER_BATCH = 8
+DEFAULT_HASHES_PER_LOOKUP = 100
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_KNOWN_HASHES = 100000
+
+# Gear table for the rolling hash, derived from sha256 so it is the same everywhere
+_GEAR = [int(hashlib.sha256("netvend gear " + str(i)).hexdigest()[:16], 16) for i in range(256)]
+_MASK64 = 2 ** 64 - 1
+
+
+def chunk_hash(chunk):
+    return hashlib.sha256(chunk).hexdigest()
+
+
+def split_chunks(data, min_size=DEFAULT_MIN_CHUNK_SIZE, avg_size=DEFAULT_AVG_CHUNK_SIZE, max_size=DEFAULT_MAX_CHUNK_SIZE):
+    """Splits data into content-defined chunks.
+
+    :param avg_size: expected chunk size, must be a power of 2
+    :return: list of chunks, which joined give data
+    """
+    mask = avg_size - 1
+    chunks = []
+    start = 0
+    length = len(data)
+    while start < length:
+        end = min(start + max_size, length)
+        pos = start + min_size
+        h = 0
+        while pos < end:
+            h = ((h << 1) + _GEAR[ord(data[pos])]) & _MASK64
+            if h & mask == 0:
+                break
+            pos += 1
+        end = min(pos + 1, end)
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+def make_manifest(data, chunks):
+    return json.dumps({"version": MANIFEST_VERSION, "size": len(data), "hash": chunk_hash(data),
+                       "chunks": [chunk_hash(chunk) for chunk in chunks]})
+
+
+def parse_manifest(encoded):
+    manifest = json.loads(encoded)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError("unsupported chunked variable version {0}".format(manifest.get("version")))
+    manifest["chunks"] = [str(h) for h in manifest["chunks"]]
+    manifest["hash"] = str(manifest["hash"])
+    return manifest
+
+
+class ChunkCache(object):
+    """Verified chunks by hash, in memory or in a directory (one file per chunk).
+
+    In memory, the least recently used chunks are evicted once they take more than max_bytes.
+
+    :param directory: directory to keep chunks in, None for memory only
+    :param max_bytes: size of the chunks kept in memory at most
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.chunks = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, h):
+        with self.lock:
+            chunk = self.chunks.pop(h, None)
+            if chunk is not None:
+                self.chunks[h] = chunk
+        if chunk is None and self.directory is not None:
+            path = os.path.join(self.directory, h)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    chunk = f.read()
+                if chunk_hash(chunk) != h:
+                    return None
+        return chunk
+
+    def put(self, h, chunk):
+        if chunk_hash(chunk) != h:
+            raise ValueError("chunk does not match hash " + h)
+        if self.directory is None:
+            if len(chunk) > self.max_bytes:
+                return
+            with self.lock:
+                old = self.chunks.pop(h, None)
+                if old is not None:
+                    self.size -= len(old)
+                self.chunks[h] = chunk
+                self.size += len(chunk)
+                while self.size > self.max_bytes:
+                    self.size -= len(self.chunks.popitem(last=False)[1])
+        else:
+            path = os.path.join(self.directory, h)
+            with open(path + ".tmp", "wb") as f:
+                f.write(chunk)
+            os.rename(path + ".tmp", path)
+
+
+class KnownHashes(object):
+    """Set of the most recently added hashes, forgetting the oldest beyond max_size."""
+    def __init__(self, max_size=DEFAULT_KNOWN_HASHES):
+        self.max_size = max_size
+        self.hashes = collections.OrderedDict()
+
+    def __contains__(self, h):
+        return h in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, h):
+        self.hashes.pop(h, None)
+        self.hashes[h] = True
+        if len(self.hashes) > self.max_size:
+            self.hashes.popitem(last=False)
+
+    def update(self, hashes):
+        for h in hashes:
+            self.add(h)
+
+
+def iter_chunks(query_rows, address, hashes, cache, workers=DEFAULT_FETCH_WORKERS,
+                chunks_per_batch=DEFAULT_CHUNKS_PER_BATCH):
+    """Yields the chunks of hashes in order, fetching missing ones with parallel query batches.
+
+    :param query_rows: function taking a list of SQL queries, returning a list of row lists
+    :param address: address that posted the chunks
+    :param hashes: chunk hashes, in order
+    :param cache: ChunkCache read from and filled with verified chunks
+    :raise ValueError: if a chunk is missing or doesn't match its hash
+    """
+    missing = []
+    for h in hashes:
+        if cache.get(h) is None and h not in missing:
+            missing.append(h)
+
+    fetched = {}
+    errors = []
+    ready = threading.Condition()
+    groups = Queue.Queue()
+    for i in range(0, len(missing), chunks_per_batch):
+        groups.put(missing[i:i + chunks_per_batch])
+
+    def fetch_group(group):
+        results = query_rows(["SELECT SUBSTRING(data, " + str(len(CHUNK_PREFIX) + len(h) + 2) + ", LENGTH(data)) "
+                              "FROM posts WHERE address = '" + address + "' "
+                              "AND data LIKE '" + CHUNK_PREFIX + h + ":%' LIMIT 1" for h in group])
+        for h, rows in zip(group, results):
+            if len(rows) == 0:
+                raise ValueError("chunk " + h + " not found")
+            chunk = str(rows[0][0])
+            cache.put(h, chunk)
+            yield h, chunk
+
+    def fetch():
+        try:
+            while True:
+                try:
+                    group = groups.get_nowait()
+                except Queue.Empty:
+                    return
+                for h, chunk in fetch_group(group):
+                    with ready:
+                        fetched[h] = chunk
+                        ready.notify_all()
+        except BaseException as e:
+            # Server errors (NetvendResponseError) are BaseExceptions too
+            with ready:
+                errors.append(e)
+        finally:
+            with ready:
+                running[0] -= 1
+                ready.notify_all()
+
+    threads = [threading.Thread(target=fetch) for _ in range(min(workers, groups.qsize()))]
+    running = [len(threads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    waiting = set(missing)
+    for h in hashes:
+        if h in waiting:
+            with ready:
+                while h not in fetched and not errors and running[0] > 0:
+                    ready.wait()
+                if errors:
+                    raise errors[0]
+                if h not in fetched:
+                    raise RuntimeError("chunk fetches stopped before chunk " + h + " was fetched")
+                # Fetched chunks are held until yielded, in case the cache has evicted them
+                chunk = fetched.pop(h)
+            waiting.discard(h)
+            yield chunk
+        else:
+            chunk = cache.get(h)
+            if chunk is None:
+                # Evicted since we looked
+                chunk = list(fetch_group([h]))[0][1]
+            yield chunk
@@ -0,0 +1,211 @@
+"""
+cryptobackend - Pluggable implementations of the crypto primitives netvendtk relies on.
+
+Every backend exposes ecdsa_sign, ecdsa_recover, privtopub and hash160 with the
+same inputs and outputs as the pybitcointools functions of the same name:
+* CoincurveBackend (libsecp256k1 through the coincurve package)
+* CryptographyBackend (OpenSSL through the cryptography package, privtopub only)
+* PurePythonBackend (pybitcointools, always available)
+
+get_backend() returns the fastest available backend. Set the environment variable
+NETVEND_CRYPTO_BACKEND or call set_backend(name) to force one.
+
+Run this module to check that every available backend agrees with the others.
+"""
+
+import os
+import sys
+import base64
+import pybitcointools
+
+
+class PurePythonBackend(object):
+    """Backend using the pure-Python big-int code in pybitcointools."""
+    name = "python"
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def ecdsa_sign(self, msg, priv):
+        return pybitcointools.ecdsa_sign(msg, priv)
+
+    def ecdsa_recover(self, msg, sig):
+        return pybitcointools.ecdsa_recover(msg, sig)
+
+    def privtopub(self, priv):
+        return pybitcointools.privtopub(priv)
+
+    def hash160(self, string):
+        return pybitcointools.hash160(string)
+
+    def pubkey_to_address(self, pubkey, magicbyte=0):
+        return pybitcointools.bin_to_b58check(self.hash160(pubkey.decode('hex')).decode('hex'), magicbyte)
+
+    def ecdsa_recover_to_address(self, msg, sig, magicbyte=0):
+        pubkey = self.ecdsa_recover(msg, sig)
+        if not pubkey:
+            return None
+        return self.pubkey_to_address(pubkey, magicbyte)
+
+
+class CoincurveBackend(PurePythonBackend):
+    """Backend using libsecp256k1 through coincurve.
+
+    Signatures use RFC6979 nonces, so unlike the pure-Python backend signing is deterministic.
+    """
+    name = "coincurve"
+
+    @classmethod
+    def available(cls):
+        try:
+            import coincurve
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        import coincurve
+        self.coincurve = coincurve
+
+    def ecdsa_sign(self, msg, priv):
+        msghash = pybitcointools.electrum_sig_hash(msg)
+        sig = self.coincurve.PrivateKey(priv.decode('hex')).sign_recoverable(msghash, hasher=None)
+        return base64.b64encode(chr(27 + ord(sig[64])) + sig[:64])
+
+    def ecdsa_recover(self, msg, sig):
+        v, r, s = pybitcointools.decode_sig(sig)
+        raw = pybitcointools.encode(r, 256, 32) + pybitcointools.encode(s, 256, 32) + chr((v - 27) & 3)
+        msghash = pybitcointools.electrum_sig_hash(msg)
+        try:
+            pubkey = self.coincurve.PublicKey.from_signature_and_message(raw, msghash, hasher=None)
+        except Exception:
+            return False
+        return pubkey.format(compressed=False).encode('hex')
+
+    def privtopub(self, priv):
+        if len(priv) != 64:
+            return super(CoincurveBackend, self).privtopub(priv)
+        return self.coincurve.PrivateKey(priv.decode('hex')).public_key.format(compressed=False).encode('hex')
+
+
+class CryptographyBackend(PurePythonBackend):
+    """Backend using OpenSSL through cryptography.
+
+    OpenSSL cannot recover public keys or report the recovery id of a signature,
+    so only privtopub is accelerated; signing and recovery use pybitcointools.
+    """
+    name = "cryptography"
+
+    @classmethod
+    def available(cls):
+        try:
+            from cryptography.hazmat.primitives.asymmetric import ec
+            from cryptography.hazmat.backends import default_backend
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.hazmat.backends import default_backend
+        self.ec = ec
+        self.openssl = default_backend()
+
+    def privtopub(self, priv):
+        if len(priv) != 64:
+            return super(CryptographyBackend, self).privtopub(priv)
+        key = self.ec.derive_private_key(pybitcointools.decode(priv, 16), self.ec.SECP256K1(), self.openssl)
+        numbers = key.public_key().public_numbers()
+        return pybitcointools.point_to_hex((numbers.x, numbers.y))
+
+
+BACKEND_CLASSES = [CoincurveBackend, CryptographyBackend, PurePythonBackend]
+
+_backend = None
+
+
+def available_backends():
+    """Returns an instance of every backend that can be used in this interpreter."""
+    return [backend_class() for backend_class in BACKEND_CLASSES if backend_class.available()]
+
+
+def set_backend(name):
+    """Selects the backend used by get_backend.
+
+    :param name: backend name (see BACKEND_CLASSES), or a backend instance
+    :return: the selected backend
+    """
+    global _backend
+    if not isinstance(name, basestring):
+        _backend = name
+        return _backend
+    for backend_class in BACKEND_CLASSES:
+        if backend_class.name == name:
+            if not backend_class.available():
+                raise ValueError("crypto backend {0} is not installed".format(name))
+            _backend = backend_class()
+            return _backend
+    raise ValueError("unknown crypto backend {0}".format(name))
+
+
+def get_backend():
+    """Returns the selected backend, picking the fastest available one on first use."""
+    if _backend is None:
+        forced = os.environ.get("NETVEND_CRYPTO_BACKEND")
+        if forced:
+            return set_backend(forced)
+        return set_backend(available_backends()[0])
+    return _backend
+
+
+CONFORMANCE_PRIVATES = [pybitcointools.sha256("netvend conformance " + str(i)) for i in range(4)]
+CONFORMANCE_MESSAGES = ["", "netvend", "[0, [\"c:[\\\"echo\\\", [1, 2]]\"]]", "x" * 1000]
+
+
+def check_conformance(backends=None, privates=CONFORMANCE_PRIVATES, messages=CONFORMANCE_MESSAGES):
+    """Checks that backends derive identical pubkeys, hashes and addresses, and that
+    signatures made by any backend verify and recover to the same pubkey under every backend.
+
+    Signature bytes themselves are not compared: the pure-Python backend uses random nonces.
+
+    :param backends: backends to compare, by default every available one
+    :return: list of mismatch descriptions, empty if all backends conform
+    """
+    if backends is None:
+        backends = available_backends()
+    reference = PurePythonBackend()
+    failures = []
+    for priv in privates:
+        pubkey = reference.privtopub(priv)
+        address = reference.pubkey_to_address(pubkey)
+        for backend in backends:
+            if backend.privtopub(priv) != pubkey:
+                failures.append("{0}: privtopub({1}) differs".format(backend.name, priv))
+            if backend.hash160(pubkey.decode('hex')) != reference.hash160(pubkey.decode('hex')):
+                failures.append("{0}: hash160 of {1} differs".format(backend.name, pubkey))
+            if backend.pubkey_to_address(pubkey) != address:
+                failures.append("{0}: address of {1} differs".format(backend.name, pubkey))
+        for signer in backends:
+            for msg in messages:
+                sig = signer.ecdsa_sign(msg, priv)
+                if not pybitcointools.ecdsa_verify(msg, sig, pubkey):
+                    failures.append("{0}: signature of {1!r} does not verify".format(signer.name, msg))
+                for recoverer in backends:
+                    if recoverer.ecdsa_recover(msg, sig) != pubkey:
+                        failures.append("{0}: recovering {1} signature of {2!r} gives another pubkey".format(
+                            recoverer.name, signer.name, msg))
+                    if recoverer.ecdsa_recover_to_address(msg, sig) != address:
+                        failures.append("{0}: recovering {1} signature of {2!r} gives another address".format(
+                            recoverer.name, signer.name, msg))
+    return failures
+
+
+if __name__ == "__main__":
+    backends = available_backends()
+    sys.stdout.write("checking backends: " + ", ".join(backend.name for backend in backends) + "\n")
+    failures = check_conformance(backends)
+    for failure in failures:
+        sys.stdout.write(failure + "\n")
+    sys.stdout.write("{0} mismatches\n".format(len(failures)))
+    sys.exit(1 if failures else 0)
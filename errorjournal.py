@@ -0,0 +1,161 @@
+"""
+errorjournal - Append-only, size-rotated journal of failed netvend responses.
+
+Records are written by a background thread, so callers never block on disk.
+Each record is a 4 byte big-endian length followed by compact JSON. When the
+in-memory queue is full, new records are dropped and counted instead of
+stalling the caller.
+
+Read a journal back with read_journal, or from the shell:
+    python errorjournal.py <journal file> [<journal file> ...]
+"""
+
+import os
+import sys
+import json
+import struct
+import threading
+import Queue
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKUPS = 3
+DEFAULT_QUEUE_SIZE = 1000
+POLL_INTERVAL = 0.1
+
+_LENGTH = struct.Struct(">I")
+
+
+class ErrorJournal(object):
+    """Journal written by a background thread.
+
+    :param path: journal file; rotated files are named path.1, path.2, ...
+    :param max_bytes: size at which the journal is rotated
+    :param backups: number of rotated files kept
+    :param queue_size: records held in memory before new ones are dropped
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.stopping = threading.Event()
+        # Opened here so a bad path fails when the journal is set up, not silently in the writer
+        self._open()
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def record(self, record):
+        """Queues a JSON-serializable record for writing.
+
+        :return: False if the queue was full or the writer has stopped, and the record was dropped
+        """
+        if self.stopping.is_set() or not self.writer.is_alive():
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def flush(self, poll_interval=0.1):
+        """Blocks until every queued record has been written, or the writer has stopped."""
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.writer.is_alive():
+                self.queue.all_tasks_done.wait(poll_interval)
+
+    def close(self):
+        """Writes the queued records and stops the writer."""
+        self.stopping.set()
+        if self.writer.is_alive():
+            try:
+                # Wakes the writer up; with a full queue it stops at the stopping flag once the queue is empty
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                pass
+            self.writer.join()
+        if not self.file.closed:
+            self.file.close()
+
+    def _open(self):
+        self.file = open(self.path, "ab")
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.path + "." + str(i)):
+                os.rename(self.path + "." + str(i), self.path + "." + str(i + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write_loop(self):
+        try:
+            while True:
+                try:
+                    record = self.queue.get(timeout=POLL_INTERVAL)
+                except Queue.Empty:
+                    if self.stopping.is_set():
+                        return
+                    continue
+                if record is None:
+                    self.queue.task_done()
+                    return
+                try:
+                    payload = json.dumps(record, separators=(",", ":"))
+                    self.file.write(_LENGTH.pack(len(payload)) + payload)
+                    self.written += 1
+                    # tell() counts buffered bytes too, so the size is checked after every record
+                    if self.file.tell() >= self.max_bytes:
+                        self._rotate()
+                    elif self.queue.empty():
+                        # Only flush once the queue has drained, so bursts are written together
+                        self.file.flush()
+                except (TypeError, ValueError, IOError, OSError):
+                    self.dropped += 1
+                    if self.file.closed:
+                        # Rotation failed and the journal can't be reopened: drop what is left
+                        self._drain()
+                        return
+                finally:
+                    self.queue.task_done()
+        finally:
+            self.file.close()
+
+    def _drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.dropped += 1
+            self.queue.task_done()
+
+
+def read_journal(path):
+    """Yields the records of a journal file in order, ignoring a partially written last record."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                return
+            (length,) = _LENGTH.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield json.loads(payload)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: errorjournal.py <journal file> [<journal file> ...]\n")
+        sys.exit(1)
+    for journal_path in sys.argv[1:]:
+        for journal_record in read_journal(journal_path):
+            sys.stdout.write(json.dumps(journal_record) + "\n")
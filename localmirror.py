@@ -0,0 +1,310 @@
+"""
+localmirror - An incrementally synced local copy of the netvend posts and pulses an agent cares about.
+
+The mirror tails the server's posts and pulses tables by id into an indexed sqlite
+store. Each sync only queries rows newer than the last ones it has seen, so
+repeated lookups (polling for calls or replies, reading variables) are answered
+locally instead of by a paid remote query.
+
+A mirror follows:
+* posts made by its watched addresses, or starting with one of its watched prefixes
+* pulses sent to or from its watched addresses, and the posts those pulses refer to
+
+A new mirror starts at the newest post, and at the pulse after the agent's last
+lastread post (all pending_calls needs). Addresses are followed from when they
+are watched on; older posts are only fetched when asked for (watch_address's
+since_post_id), so watching a busy address doesn't page through its whole
+history. latest_post_data fetches the newest older post it needs once per
+address and prefix.
+
+Sync queries don't raise on truncated results: the rows that came back are
+stored, cursors only move past them, and the page is halved until it fits in
+max_size_cost. A single post larger than max_size_cost raises RuntimeError.
+
+    mirror = LocalMirror(agent, "mirror.sqlite")
+    mirror.watch_address(service_address)
+    agent.set_mirror(mirror)
+"""
+
+import json
+import sqlite3
+import thread
+import netvendtk
+
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_MAX_SIZE_COST = 1000000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (post_id INTEGER PRIMARY KEY, address TEXT, data TEXT);
+CREATE TABLE IF NOT EXISTS pulses (pulse_id INTEGER PRIMARY KEY, from_address TEXT, to_address TEXT,
+                                   value INTEGER, post_id INTEGER);
+CREATE TABLE IF NOT EXISTS cursors (name TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS watched (kind TEXT, value TEXT, PRIMARY KEY (kind, value));
+CREATE INDEX IF NOT EXISTS posts_address ON posts (address, post_id);
+CREATE INDEX IF NOT EXISTS pulses_to_address ON pulses (to_address, pulse_id);
+"""
+
+
+def quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class LocalMirror(object):
+    """Local sqlite mirror of posts and pulses, synced through agent.
+
+    :param agent: AgentBasic used to query the server; its own address is always watched
+    :param db_path: sqlite database path, reopened mirrors resume where they stopped
+    :param addresses: addresses to watch in addition to the agent's, from the mirror's cursor on
+    :param prefixes: post data prefixes to watch, from any address
+    :param page_size: rows fetched per table per query, halved while results are truncated
+    :param max_size_cost: max_size_cost of each sync query, must fit the largest mirrored post
+    """
+    def __init__(self, agent, db_path=":memory:", addresses=None, prefixes=None,
+                 page_size=DEFAULT_PAGE_SIZE, max_size_cost=DEFAULT_MAX_SIZE_COST):
+        self.agent = agent
+        self.page_size = page_size
+        self.max_size_cost = max_size_cost
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = thread.allocate_lock()
+        self.sync_lock = thread.allocate_lock()
+
+        self.addresses = set(str(row[0]) for row in self.db.execute("SELECT value FROM watched WHERE kind = 'address'"))
+        self.prefixes = set(str(row[0]) for row in self.db.execute("SELECT value FROM watched WHERE kind = 'prefix'"))
+        self.seeded = set(str(row[0]) for row in self.db.execute("SELECT value FROM watched WHERE kind = 'latest'"))
+        for address in [agent.get_address()] + list(addresses or []):
+            self.watch_address(address)
+        for prefix in prefixes or []:
+            self.watch_prefix(prefix)
+
+    @property
+    def last_post_id(self):
+        return self._cursor("post_id")
+
+    @property
+    def last_pulse_id(self):
+        return self._cursor("pulse_id")
+
+    def _cursor(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM cursors WHERE name = ?", (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _start(self):
+        """Sets the cursors of a new mirror to the newest post and to the agent's last lastread pulse."""
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM cursors WHERE name = 'post_id'").fetchone() is not None:
+                return
+        address = self.agent.get_address()
+        prefix = netvendtk.LASTREAD_PREFIX
+        newest, lastread = self._query(["SELECT MAX(post_id) FROM posts",
+                                        "SELECT post_id, address, data FROM posts WHERE address = " + quote(address) +
+                                        " AND data LIKE " + quote(prefix + "%") + " ORDER BY post_id DESC LIMIT 1"])
+        self._check_fits(lastread, 1, "lastread post of " + address)
+        self._store_posts(lastread.rows)
+        pulse_cursor = 0
+        if lastread.rows:
+            try:
+                pulse_cursor = int(str(lastread.rows[0][2])[len(prefix):])
+            except ValueError:
+                pass
+        seed = json.dumps([address, prefix])
+        self._watch("latest", seed)
+        self.seeded.add(seed)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cursors (name, value) VALUES ('post_id', ?)",
+                            (int(newest.rows[0][0] or 0),))
+            self.db.execute("INSERT OR REPLACE INTO cursors (name, value) VALUES ('pulse_id', ?)", (pulse_cursor,))
+            self.db.commit()
+
+    def watch_address(self, address, since_post_id=None):
+        """Starts following address.
+
+        :param since_post_id: also fetch the address's posts after this post_id that are older than the
+                              mirror's cursor, 0 for its whole history; None to fetch none
+        """
+        if address in self.addresses:
+            return
+        with self.sync_lock:
+            if since_post_id is not None:
+                self._start()
+            cursor = self.last_post_id
+            after = cursor if since_post_id is None else since_post_id
+            page_size = self.page_size
+            while cursor > after:
+                result = self._query(["SELECT post_id, address, data FROM posts WHERE address = " + quote(address) +
+                                      " AND post_id > " + str(after) + " AND post_id <= " + str(cursor) +
+                                      " ORDER BY post_id ASC LIMIT " + str(page_size)])[0]
+                self._check_fits(result, page_size, "post after " + str(after))
+                self._store_posts(result.rows)
+                if not result.truncated and len(result.rows) < page_size:
+                    break
+                if result.rows:
+                    after = int(result.rows[-1][0])
+                page_size = self._next_page_size(result, page_size)
+            self._watch("address", address)
+            self.addresses.add(address)
+
+    def watch_prefix(self, prefix):
+        """Starts following posts starting with prefix. Older posts are not fetched."""
+        if prefix in self.prefixes:
+            return
+        with self.sync_lock:
+            self._watch("prefix", prefix)
+            self.prefixes.add(prefix)
+
+    def _watch(self, kind, value):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO watched (kind, value) VALUES (?, ?)", (kind, value))
+            self.db.commit()
+
+    def _query(self, queries):
+        return self.agent.query_many_results(queries, max_size_cost=self.max_size_cost)
+
+    def _check_fits(self, result, page_size, what):
+        if result.truncated and not result.rows and page_size == 1:
+            raise RuntimeError("{0} is larger than the mirror's max_size_cost {1}".format(what, self.max_size_cost))
+
+    def _next_page_size(self, result, page_size):
+        """Returns the page size to use after result: halved if it was truncated, grown back towards page_size if not."""
+        if result.truncated:
+            return max(1, page_size // 2)
+        return min(self.page_size, page_size * 2)
+
+    def _fetch_posts(self, post_ids):
+        """Fetches and stores the posts with the given post_ids, in pages."""
+        post_ids = sorted(post_ids)
+        page_size = self.page_size
+        while post_ids:
+            page = post_ids[:page_size]
+            result = self._query(["SELECT post_id, address, data FROM posts WHERE post_id IN (" +
+                                  ",".join(str(post_id) for post_id in page) + ") ORDER BY post_id ASC"])[0]
+            self._check_fits(result, len(page), "post " + str(page[0]))
+            self._store_posts(result.rows)
+            if result.truncated:
+                # Rows come back in post_id order, the ones after the last returned row are fetched again
+                fetched = set(int(row[0]) for row in result.rows)
+                post_ids = [post_id for post_id in post_ids if post_id not in fetched]
+            else:
+                post_ids = post_ids[len(page):]
+            page_size = self._next_page_size(result, page_size)
+
+    def _store_posts(self, rows):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO posts (post_id, address, data) VALUES (?, ?, ?)",
+                                [(int(post_id), str(address), data) for post_id, address, data in rows])
+            self.db.commit()
+
+    def sync(self):
+        """Fetches every watched post and pulse newer than the last sync.
+
+        :return: number of new posts and pulses stored
+        """
+        with self.sync_lock:
+            self._start()
+            address_list = ",".join(quote(address) for address in sorted(self.addresses))
+            post_filter = ["address IN (" + address_list + ")"]
+            for prefix in sorted(self.prefixes):
+                post_filter.append("data LIKE " + quote(prefix + "%"))
+            stored = 0
+            post_page_size, pulse_page_size = self.page_size, self.page_size
+
+            while True:
+                post_cursor, pulse_cursor = self.last_post_id, self.last_pulse_id
+                # The newest post_id is queried first, so every watched post up to it is in a posts page that isn't full
+                newest, posts, pulses = self._query([
+                    "SELECT MAX(post_id) FROM posts",
+                    "SELECT post_id, address, data FROM posts WHERE post_id > " + str(post_cursor) +
+                    " AND (" + " OR ".join(post_filter) + ") ORDER BY post_id ASC LIMIT " + str(post_page_size),
+                    "SELECT pulse_id, from_address, to_address, value, post_id FROM pulses WHERE pulse_id > " +
+                    str(pulse_cursor) + " AND (to_address IN (" + address_list + ") OR from_address IN (" +
+                    address_list + ")) ORDER BY pulse_id ASC LIMIT " + str(pulse_page_size)])
+                self._check_fits(posts, post_page_size, "post after " + str(post_cursor))
+                self._check_fits(pulses, pulse_page_size, "pulse after " + str(pulse_cursor))
+                # A page is complete when it wasn't truncated, and the last one when it also isn't full
+                posts_done = not posts.truncated and len(posts.rows) < post_page_size
+                pulses_done = not pulses.truncated and len(pulses.rows) < pulse_page_size
+                post_page_size = self._next_page_size(posts, post_page_size)
+                pulse_page_size = self._next_page_size(pulses, pulse_page_size)
+                newest, posts, pulses = newest.rows, posts.rows, pulses.rows
+
+                self._store_posts(posts)
+
+                # Pulses may refer to posts by addresses we don't watch (calls to our services)
+                with self.lock:
+                    missing = set()
+                    for pulse in pulses:
+                        if pulse[4] is not None and int(pulse[4]) > 0 and self.db.execute(
+                                "SELECT 1 FROM posts WHERE post_id = ?", (int(pulse[4]),)).fetchone() is None:
+                            missing.add(int(pulse[4]))
+                self._fetch_posts(missing)
+                with self.lock:
+                    self.db.executemany("INSERT OR REPLACE INTO pulses (pulse_id, from_address, to_address, value, post_id) "
+                                        "VALUES (?, ?, ?, ?, ?)",
+                                        [(int(pulse_id), str(from_address), str(to_address), int(value),
+                                          None if post_id is None else int(post_id))
+                                         for pulse_id, from_address, to_address, value, post_id in pulses])
+                    if posts_done and newest[0][0] is not None:
+                        # Nothing watched up to the newest post is left, skip unwatched posts next time
+                        post_cursor = max(post_cursor, int(newest[0][0]))
+                    if posts:
+                        post_cursor = max(post_cursor, int(posts[-1][0]))
+                    self.db.execute("INSERT OR REPLACE INTO cursors (name, value) VALUES ('post_id', ?)",
+                                    (post_cursor,))
+                    if pulses:
+                        self.db.execute("INSERT OR REPLACE INTO cursors (name, value) VALUES ('pulse_id', ?)",
+                                        (int(pulses[-1][0]),))
+                    self.db.commit()
+                stored += len(posts) + len(pulses)
+
+                if posts_done and pulses_done:
+                    return stored
+
+    def latest_post_data(self, address, prefix):
+        """Returns the data of the newest post by address starting with prefix, or None.
+
+        The first lookup of an address and prefix fetches the newest such post older than the mirror's
+        cursor, in case it was made before the address was watched.
+        """
+        seed = json.dumps([address, prefix])
+        if seed not in self.seeded:
+            with self.sync_lock:
+                self._start()
+                cursor = self.last_post_id
+                result = self._query(["SELECT post_id, address, data FROM posts WHERE address = " + quote(address) +
+                                      " AND post_id <= " + str(cursor) + " AND data LIKE " + quote(prefix + "%") +
+                                      " ORDER BY post_id DESC LIMIT 1"])[0]
+                self._check_fits(result, 1, "latest post of " + address)
+                self._store_posts(result.rows)
+                self._watch("latest", seed)
+                self.seeded.add(seed)
+        with self.lock:
+            row = self.db.execute("SELECT data FROM posts WHERE address = ? AND substr(data, 1, ?) = ? "
+                                  "ORDER BY post_id DESC LIMIT 1", (address, len(prefix), prefix)).fetchone()
+        return None if row is None else str(row[0])
+
+    def posts_after(self, address, prefix, after_post_id, limit=None):
+        """Returns [post_id, data] of posts by address starting with prefix and newer than after_post_id, oldest first."""
+        query = "SELECT post_id, data FROM posts WHERE address = ? AND post_id > ? AND substr(data, 1, ?) = ? ORDER BY post_id ASC"
+        params = (address, after_post_id, len(prefix), prefix)
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+        with self.lock:
+            return [[row[0], str(row[1])] for row in self.db.execute(query, params)]
+
+    def pending_calls(self, address, lowest_fee, lastread_prefix=netvendtk.LASTREAD_PREFIX,
+                      call_prefix=netvendtk.CALL_PREFIX):
+        """Returns the rows ServiceAgent.work would fetch remotely: calls to address after its last lastread post.
+
+        :return: list of [pulse_id, from_address, value, post_id, data]
+        """
+        lastread = self.latest_post_data(address, lastread_prefix)
+        last_pulse_id = 0 if lastread is None else int(lastread[len(lastread_prefix):])
+        with self.lock:
+            return [list(row) for row in self.db.execute(
+                "SELECT pulses.pulse_id, pulses.from_address, pulses.value, pulses.post_id, posts.data "
+                "FROM pulses JOIN posts ON pulses.post_id = posts.post_id "
+                "WHERE pulses.to_address = ? AND pulses.pulse_id > ? AND pulses.value >= ? "
+                "AND substr(posts.data, 1, ?) = ? ORDER BY pulses.pulse_id ASC",
+                (address, last_pulse_id, lowest_fee, len(call_prefix), call_prefix))]
@@ -0,0 +1,289 @@
+"""
+mockserver - A local stand-in for the netvend server, for tests and benchmarks.
+
+MockServer speaks the command.php batch protocol used by netvendtk.AgentBasic:
+it checks batch signatures, keeps accounts, posts and pulses in sqlite, answers
+SQL queries against them and reports charged/time_cost/size_cost like the real
+server. Costs and fees are made up, but follow the same shape.
+
+    server = MockServer()
+    server.start()
+    agent = netvendtk.Agent("seed", url=server.url)
+    ...
+    server.stop()
+
+Run this module to serve on a fixed port: python mockserver.py [port]
+"""
+
+import sys
+import time
+import json
+import sqlite3
+import thread
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import cryptobackend
+
+BATCHTYPE_POST = 0
+BATCHTYPE_PULSE = 1
+BATCHTYPE_QUERY = 2
+BATCHTYPE_WITHDRAW = 3
+
+POST_FEE_PER_BYTE = 1
+PULSE_FEE = 1
+WITHDRAW_FEE = 1000
+DEFAULT_INITIAL_BALANCE = 0
+
+SCHEMA = """
+CREATE TABLE accounts (address TEXT PRIMARY KEY, balance INTEGER NOT NULL);
+CREATE TABLE history (history_id INTEGER PRIMARY KEY, address TEXT, batch_type INTEGER, sig TEXT, time REAL);
+CREATE TABLE posts (post_id INTEGER PRIMARY KEY, history_id INTEGER, address TEXT, data TEXT);
+CREATE TABLE pulses (pulse_id INTEGER PRIMARY KEY, history_id INTEGER, from_address TEXT, to_address TEXT,
+                     value INTEGER, post_id INTEGER);
+CREATE TABLE withdrawals (withdrawal_id INTEGER PRIMARY KEY, history_id INTEGER, address TEXT, amount INTEGER,
+                          to_address TEXT);
+CREATE INDEX posts_address ON posts (address, post_id);
+CREATE INDEX pulses_to_address ON pulses (to_address, pulse_id);
+"""
+
+
+class CommandError(Exception):
+    def __init__(self, message, pos_in_batch=None):
+        super(CommandError, self).__init__(message)
+        self.pos_in_batch = pos_in_batch
+
+
+class MockServer(object):
+    """In-process netvend server.
+
+    :param db_path: sqlite database path, ":memory:" by default
+    :param host: interface to bind
+    :param port: port to bind, 0 picks a free one
+    :param initial_balance: balance given to accounts the first time they are seen
+    """
+    def __init__(self, db_path=":memory:", host="127.0.0.1", port=0, initial_balance=DEFAULT_INITIAL_BALANCE):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        if sqlite3.sqlite_version_info < (3, 34, 0):
+            self.db.create_function("SUBSTRING", 3, lambda s, start, length: None if s is None else s[start - 1:start - 1 + length])
+        self.lock = thread.allocate_lock()
+        self.host = host
+        self.port = port
+        self.initial_balance = initial_balance
+        self.signer_cache = {}
+        self.httpd = None
+        self.stats = {"requests": 0, "batches": 0, "commands": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0,
+                      "charged": 0, "time_cost": 0, "size_cost": 0, "handle_time": 0.0}
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/command.php".format(self.host, self.port)
+
+    def start(self):
+        """Starts serving HTTP on a background thread."""
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.getheader("content-length", 0))
+                fields = urlparse.parse_qs(self.rfile.read(length))
+                body = server.handle_command(dict((key, values[0]) for key, values in fields.items()))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.httpd.server_address[1]
+        serve_thread = threading.Thread(target=self.httpd.serve_forever)
+        serve_thread.daemon = True
+        serve_thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def credit(self, address, amount):
+        with self.lock:
+            self._ensure_account(address)
+            self.db.execute("UPDATE accounts SET balance = balance + ? WHERE address = ?", (amount, address))
+            self.db.commit()
+
+    def balance(self, address):
+        with self.lock:
+            row = self.db.execute("SELECT balance FROM accounts WHERE address = ?", (address,)).fetchone()
+        return None if row is None else row[0]
+
+    def handle_command(self, arg_dict):
+        """Handles one command.php request.
+
+        :param arg_dict: form fields of the request ("version", "batches")
+        :return: the JSON response body
+        """
+        start = time.time()
+        request_data = arg_dict.get("batches", "")
+        responses = []
+        with self.lock:
+            try:
+                batches = json.loads(request_data)
+            except ValueError:
+                batches = None
+            if not isinstance(batches, list):
+                responses.append([False, "could not parse batches", None, None])
+            else:
+                batch_first_ids = []
+                for signed_batch in batches:
+                    charged = 0
+                    try:
+                        encoded_batch, sig = [part.encode("utf-8") for part in signed_batch]
+                        address = self._signer(encoded_batch, sig)
+                        batch_type, commands = json.loads(encoded_batch)
+                        result, charged = self._run_batch(address, batch_type, commands, sig, batch_first_ids)
+                        self.db.commit()
+                        responses.append([True, result])
+                        self.stats["batches"] += 1
+                        self.stats["commands"] += len(commands)
+                        self.stats["charged"] += charged
+                    except CommandError as e:
+                        self.db.rollback()
+                        responses.append([False, str(e), e.pos_in_batch, None])
+                        break
+                    except (ValueError, TypeError, IndexError) as e:
+                        self.db.rollback()
+                        responses.append([False, "malformed batch: " + str(e), None, None])
+                        break
+            if not responses[-1][0]:
+                self.stats["errors"] += 1
+            body = json.dumps(responses)
+            self.stats["requests"] += 1
+            self.stats["bytes_in"] += len(request_data)
+            self.stats["bytes_out"] += len(body)
+            self.stats["handle_time"] += time.time() - start
+        return body
+
+    def _signer(self, encoded_batch, sig):
+        # Identical signed batches (e.g. repeated polling queries) are only recovered once
+        key = (encoded_batch, sig)
+        address = self.signer_cache.get(key)
+        if address is None:
+            address = cryptobackend.get_backend().ecdsa_recover_to_address(encoded_batch, sig)
+            if not address:
+                raise CommandError("invalid signature")
+            if len(self.signer_cache) > 10000:
+                self.signer_cache.clear()
+            self.signer_cache[key] = address
+        return address
+
+    def _ensure_account(self, address):
+        self.db.execute("INSERT OR IGNORE INTO accounts (address, balance) VALUES (?, ?)", (address, self.initial_balance))
+
+    def _charge(self, address, amount, pos_in_batch=None):
+        balance = self.db.execute("SELECT balance FROM accounts WHERE address = ?", (address,)).fetchone()[0]
+        if balance < amount:
+            raise CommandError("insufficient funds", pos_in_batch)
+        self.db.execute("UPDATE accounts SET balance = balance - ? WHERE address = ?", (amount, address))
+
+    def _run_batch(self, address, batch_type, commands, sig, batch_first_ids):
+        self._ensure_account(address)
+        history_id = self.db.execute("INSERT INTO history (address, batch_type, sig, time) VALUES (?, ?, ?, ?)",
+                                     (address, batch_type, sig, time.time())).lastrowid
+        charged = 0
+        first_id = None
+
+        if batch_type == BATCHTYPE_POST:
+            for i, data in enumerate(commands):
+                fee = POST_FEE_PER_BYTE * len(data)
+                self._charge(address, fee, i)
+                charged += fee
+                post_id = self.db.execute("INSERT INTO posts (history_id, address, data) VALUES (?, ?, ?)",
+                                          (history_id, address, data)).lastrowid
+                if first_id is None:
+                    first_id = post_id
+            batch_first_ids.append(first_id)
+            return [first_id, history_id, charged], charged
+
+        elif batch_type == BATCHTYPE_PULSE:
+            for i, pulse in enumerate(commands):
+                to_address, value = str(pulse[0]), int(pulse[1])
+                post_id = pulse[2] if len(pulse) > 2 else 0
+                if len(pulse) > 3:
+                    # post_id is an index into the post batch at position pulse[3] of this request
+                    if pulse[3] >= len(batch_first_ids) or batch_first_ids[pulse[3]] is None:
+                        raise CommandError("pulse refers to a batch that has no posts", i)
+                    post_id = batch_first_ids[pulse[3]] + post_id
+                self._charge(address, value + PULSE_FEE, i)
+                charged += PULSE_FEE
+                self._ensure_account(to_address)
+                self.db.execute("UPDATE accounts SET balance = balance + ? WHERE address = ?", (value, to_address))
+                pulse_id = self.db.execute("INSERT INTO pulses (history_id, from_address, to_address, value, post_id) "
+                                           "VALUES (?, ?, ?, ?, ?)",
+                                           (history_id, address, to_address, value, post_id or None)).lastrowid
+                if first_id is None:
+                    first_id = pulse_id
+            batch_first_ids.append(None)
+            return [first_id, history_id, charged], charged
+
+        elif batch_type == BATCHTYPE_QUERY:
+            results = []
+            for i, (query, max_time_cost, max_size_cost) in enumerate(commands):
+                if not query.lstrip().upper().startswith("SELECT"):
+                    raise CommandError("only SELECT queries are allowed", i)
+                start = time.time()
+                try:
+                    rows = [list(row) for row in self.db.execute(query).fetchall()]
+                except sqlite3.Error as e:
+                    raise CommandError("query error: " + str(e), i)
+                # time cost is in microseconds of query time, size cost in bytes of returned rows
+                time_cost = max(1, int((time.time() - start) * 1000000))
+                truncated = 0
+                size_cost = len(json.dumps(rows))
+                while size_cost > max_size_cost and rows:
+                    rows.pop()
+                    truncated = 1
+                    size_cost = len(json.dumps(rows))
+                self._charge(address, time_cost + size_cost, i)
+                charged += time_cost + size_cost
+                self.stats["time_cost"] += time_cost
+                self.stats["size_cost"] += size_cost
+                results.append([rows, time_cost, size_cost, truncated])
+            batch_first_ids.append(None)
+            return [results, history_id, charged], charged
+
+        elif batch_type == BATCHTYPE_WITHDRAW:
+            for i, withdraw in enumerate(commands):
+                amount = int(withdraw[0])
+                to_address = withdraw[1] if len(withdraw) > 1 else address
+                self._charge(address, amount + WITHDRAW_FEE, i)
+                charged += WITHDRAW_FEE
+                withdrawal_id = self.db.execute("INSERT INTO withdrawals (history_id, address, amount, to_address) "
+                                                "VALUES (?, ?, ?, ?)",
+                                                (history_id, address, amount, to_address)).lastrowid
+                if first_id is None:
+                    first_id = withdrawal_id
+            batch_first_ids.append(None)
+            return [first_id, history_id, charged], charged
+
+        raise CommandError("unknown batch type " + str(batch_type))
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = MockServer(port=port, initial_balance=10 ** 12).start()
+    sys.stdout.write("serving on " + server.url + "\n")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -19,13 +19,22 @@ Created by:
 Special Thanks to /u/minisat_maker on reddit for the orginal concept for netvend.
 """
 
+import os
 import sys
 import thread
-import math
+import threading
+import decimal
 import time
-import pickle
 import json
+import hmac
+import hashlib
+import collections
+import contextlib
 import pybitcointools
+import cryptobackend
+import errorjournal
+import payloadcodec
+import chunkstore
 
 if sys.hexversion < 0x02000000 or sys.hexversion >= 0x03000000:
     raise RuntimeError("netvend requires Python 2.x.")
@@ -53,18 +62,33 @@ BATCHTYPE_PULSE = 1
 BATCHTYPE_QUERY = 2
 BATCHTYPE_WITHDRAW = 3
 
+BATCHTYPE_NAMES = {BATCHTYPE_POST: "post", BATCHTYPE_PULSE: "pulse",
+                   BATCHTYPE_QUERY: "query", BATCHTYPE_WITHDRAW: "withdraw"}
+
 DEFAULT_QUERY_MAX_TIME_COST = 1000
 DEFAULT_QUERY_MAX_SIZE_COST = 100000
 
 LASTREAD_PREFIX = "l:"
 RETURN_PREFIX = "r:"
 CALL_PREFIX = "c:"
+SIGNED_PREFIX = "s:"
+CODECS_VAR = "codecs"
+
+DEFAULT_SIG_CACHE_SIZE = 1024
+DEFAULT_VERIFY_CANDIDATES = 10
+
+LANE_INTERACTIVE = "interactive"
+LANE_DEFAULT = "default"
+LANE_BULK = "bulk"
+DEFAULT_LANE_CONNECTIONS = 4
 
 UNIT_POWERS = {"usat": 0, "msat": 3, "sat": 6, "ksat": 9, "Msat": 12,
                "ubtc": 8, "mbtc": 11, "btc": 14, "kbtc": 17, "Mbtc": 20,
                "ubit": 2, "mbit": 5, "bit": 8, "kbit": 11, "Mbit": 14,
                "base": 0}
 
+_numpy_module = []
+
 
 def unit_pow(unit):
     """Return the unit in usats as a power of 10.
@@ -72,29 +96,131 @@ def unit_pow(unit):
     :param unit: commonly used bitcoin unit abbreviation (see UNIT_POWERS)
     :return: unit in usats as a power of 10
     """
-    if unit in UNIT_POWERS.keys():
-        return UNIT_POWERS[unit]
-    elif unit.lower() in UNIT_POWERS.keys():
+    if unit in UNIT_POWERS:
         return UNIT_POWERS[unit]
+    elif unit.lower() in UNIT_POWERS:
+        return UNIT_POWERS[unit.lower()]
     else:
         raise ValueError("cannot recognize unit {0}".format(unit))
 
 
+def exact_amount(amount):
+    """Returns amount as an int or a Decimal, without rounding.
+
+    Floats are taken at their shortest repr ("0.1" rather than the binary value), strings are parsed.
+    """
+    if isinstance(amount, (int, long, decimal.Decimal)):
+        return amount
+    if isinstance(amount, float):
+        return decimal.Decimal(repr(amount))
+    if isinstance(amount, basestring):
+        try:
+            return decimal.Decimal(amount)
+        except decimal.InvalidOperation:
+            raise ValueError("cannot parse amount {0!r}".format(amount))
+    raise TypeError("amount must be a number, not " + type(amount).__name__)
+
+
+def shift_decimal(amount, delta_pow):
+    """Returns amount * 10 ** delta_pow exactly, as an int if it is integral and a Decimal otherwise."""
+    amount = exact_amount(amount)
+    if isinstance(amount, (int, long)):
+        if delta_pow >= 0:
+            return amount * 10 ** delta_pow
+        quotient, remainder = divmod(amount, 10 ** -delta_pow)
+        if remainder == 0:
+            return quotient
+        # Parsing the scientific notation is exact, and faster than building the Decimal from a tuple
+        return decimal.Decimal("%dE%d" % (amount, delta_pow))
+    sign, digits, exponent = amount.as_tuple()
+    if not isinstance(exponent, int):
+        raise ValueError("cannot convert amount {0}".format(amount))
+    # Moving the exponent is exact, unlike multiplying in a decimal context
+    result = decimal.Decimal((sign, digits, exponent + delta_pow))
+    if result == result.to_integral_value():
+        return int(result)
+    return result
+
+
 def convert_value(amount, from_unit, to_unit="base"):
     """Converts amount between units, by default to base units.
 
-    :param amount: amount of from_unit
+    :param amount: amount of from_unit: int, Decimal, float or str
     :param from_unit: unit converted from
     :param to_unit: unit converted to
-    :return: converted amount as float or int if is_integer()
+    :return: exact converted amount, as int if it is integral and Decimal otherwise
     """
-    from_pow = unit_pow(from_unit)
-    to_pow = unit_pow(to_unit)
-    delta_pow = from_pow - to_pow
-    result = amount * math.pow(10, delta_pow)
-    if result.is_integer():
-        return int(result)
-    return result
+    return shift_decimal(amount, unit_pow(from_unit) - unit_pow(to_unit))
+
+
+def convert_values(amounts, from_unit, to_unit="base"):
+    """Converts a column of amounts between units exactly, see convert_value.
+
+    Columns of integers or digit strings (as query rows return them) are parsed and converted in bulk;
+    other columns, and columns with fractional results, are converted amount by amount.
+
+    :param amounts: sequence or NumPy array of amounts of from_unit, e.g. a column of query rows
+    :return: with NumPy installed, a NumPy array: int64 if every result fits, of ints and Decimals otherwise;
+             without it, a list of ints and Decimals as convert_value returns them
+    """
+    delta_pow = unit_pow(from_unit) - unit_pow(to_unit)
+    numpy = load_numpy()
+    if numpy is not None:
+        return _convert_values_numpy(numpy, amounts, delta_pow)
+
+    if not isinstance(amounts, (list, tuple)):
+        amounts = list(amounts)
+    if amounts and all(isinstance(amount, basestring) for amount in amounts):
+        try:
+            amounts = [int(amount) for amount in amounts]
+        except ValueError:
+            pass  # Fractional amounts, converted one by one below
+    if all(type(amount) in (int, long) for amount in amounts):
+        if delta_pow >= 0:
+            factor = 10 ** delta_pow
+            return [amount * factor for amount in amounts]
+        divisor = 10 ** -delta_pow
+        if all(amount % divisor == 0 for amount in amounts):
+            return [amount // divisor for amount in amounts]
+    return [shift_decimal(amount, delta_pow) for amount in amounts]
+
+
+def load_numpy():
+    """Returns the numpy module, or None if it isn't installed.
+
+    NumPy is only imported on first use, so importing netvendtk stays fast.
+    """
+    if not _numpy_module:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_module.append(numpy)
+    return _numpy_module[0]
+
+
+def _convert_values_numpy(numpy, amounts, delta_pow):
+    column = numpy.asarray(amounts)
+    if column.dtype.kind in "SU":
+        try:
+            column = column.astype(numpy.int64)
+        except (ValueError, OverflowError):
+            pass  # Fractional or larger than 64 bits, converted one by one below
+    if column.dtype.kind in "iu" and column.size > 0:
+        int64 = numpy.iinfo(numpy.int64)
+        if delta_pow >= 0:
+            factor = 10 ** delta_pow
+            if factor <= int64.max and int64.min // factor <= column.min() and column.max() <= int64.max // factor:
+                return column.astype(numpy.int64) * factor
+        else:
+            divisor = 10 ** -delta_pow
+            if divisor <= int64.max and column.max() <= int64.max:
+                column = column.astype(numpy.int64)
+                if not (column % divisor).any():
+                    return column // divisor
+    elif column.size == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.array([shift_decimal(amount, delta_pow) for amount in column.tolist()], dtype=object)
 
 
 def format_value(usats, round_decimals=3, return_list=False):
@@ -103,29 +229,38 @@ def format_value(usats, round_decimals=3, return_list=False):
     :param usats: amount in usats, use convert_value to get from other units
     :param round_decimals: amount of decimal places to round to, False to not round
     :param return_list: if True a tuple of amount and unit will be returned instead
-    :return: by default formatted str like "amount unit", see return_list
+    :return: by default formatted str like "amount unit", see return_list; rounded amounts are Decimals
     """
-    if usats > math.pow(10, 13):
+    if usats > 10 ** 13:
         unit = 'BTC'
-    elif usats > math.pow(10, 10):
+    elif usats > 10 ** 10:
         unit = 'mBTC'
-    elif usats > math.pow(10, 7):
+    elif usats > 10 ** 7:
         unit = 'uBTC'
-    elif usats > math.pow(10, 5):
+    elif usats > 10 ** 5:
         unit = 'sat'
-    elif usats > math.pow(10, 2):
+    elif usats > 10 ** 2:
         unit = 'msat'
     else:
         unit = 'usat'
 
     amount = convert_value(usats, 'usat', unit)
 
-    if round_decimals is not False:
-        amount = round(amount, round_decimals)
+    if round_decimals is False:
+        text = str(amount) if isinstance(amount, (int, long)) else "{0:f}".format(amount).rstrip("0")
+    else:
+        amount = decimal.Decimal(amount)
+        amount = amount.quantize(decimal.Decimal(1).scaleb(-round_decimals), decimal.ROUND_HALF_EVEN,
+                                 decimal.Context(prec=len(amount.as_tuple().digits) + round_decimals + 1))
+        # Printed like the rounded floats format_value used to print: "1.0", "1234.568"
+        if amount == amount.to_integral_value():
+            text = str(int(amount)) + ".0"
+        else:
+            text = "{0:f}".format(amount).rstrip("0")
     if return_list:
         return amount, unit
     else:
-        return "{0} {1}".format(amount, unit)
+        return "{0} {1}".format(text, unit)
 
 
 def convert_json_unicode_to_str(input):
@@ -144,6 +279,249 @@ def convert_json_unicode_to_str(input):
         return input
         
         
+def split_signed(body):
+    """Splits an optional "s:<sig>:" prefix (see ServiceAgent.set_verification) off a post body.
+
+    :param body: post data with its call/return prefix removed
+    :return: tuple of signature (None if unsigned) and the remaining body
+    """
+    if body.startswith(SIGNED_PREFIX):
+        sig, _, body = body[len(SIGNED_PREFIX):].partition(":")
+        return sig, body
+    return None, body
+
+
+class SignatureVerifier(object):
+    """Recovers the signing address of messages, remembering recent results.
+
+    :param cache_size: number of (message digest, sig) -> address results kept
+    """
+    def __init__(self, cache_size=DEFAULT_SIG_CACHE_SIZE):
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.lock = thread.allocate_lock()
+        self.hits = 0
+        self.misses = 0
+
+    def recover_address(self, msg, sig):
+        key = (pybitcointools.bin_sha256(msg), sig)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                address = self.cache.pop(key)
+                self.cache[key] = address
+                return address
+            self.misses += 1
+
+        try:
+            address = cryptobackend.get_backend().ecdsa_recover_to_address(msg, sig)
+        except Exception:
+            address = None
+
+        with self.lock:
+            self.cache[key] = address
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return address
+
+    def verify(self, msg, sig, address):
+        return sig is not None and self.recover_address(msg, sig) == address
+
+    def verify_batch(self, items):
+        """Verifies a list of (msg, sig, address) tuples, recovering each distinct (msg, sig) once.
+
+        :return: list of bools, True where sig is a signature of msg by address
+        """
+        recovered = {}
+        results = []
+        for msg, sig, address in items:
+            if sig is None:
+                results.append(False)
+                continue
+            if (msg, sig) not in recovered:
+                recovered[(msg, sig)] = self.recover_address(msg, sig)
+            results.append(recovered[(msg, sig)] == address)
+        return results
+
+
+class InMemoryMetrics(object):
+    """Collects agent metrics in memory, see AgentCore.set_metrics.
+
+    Agents report timings (in seconds) with observe and counts with increment. Any object with these
+    two methods can be used instead, e.g. to forward to another metrics system.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self.lock = thread.allocate_lock()
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                self.timings[key] = [1, value, value, value]
+            else:
+                timing[0] += 1
+                timing[1] += value
+                timing[2] = min(timing[2], value)
+                timing[3] = max(timing[3], value)
+
+    def snapshot(self):
+        """Returns a dict of counters and timings ({"count", "sum", "min", "max"}), keyed by (name, labels)."""
+        with self.lock:
+            snapshot = dict(self.counters)
+            for key, (count, total, low, high) in self.timings.items():
+                snapshot[key] = {"count": count, "sum": total, "min": low, "max": high}
+        return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timings = {}
+
+    def to_prometheus(self, prefix="netvend_"):
+        """Renders the metrics in the Prometheus text exposition format."""
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE {0}{1}_total counter".format(prefix, name))
+                typed.add(name)
+            lines.append("{0}{1}_total{2} {3}".format(prefix, name, format_labels(labels), value))
+        for (name, labels), (count, total, low, high) in timings:
+            if name not in typed:
+                lines.append("# TYPE {0}{1} summary".format(prefix, name))
+                typed.add(name)
+            lines.append("{0}{1}_count{2} {3}".format(prefix, name, format_labels(labels), count))
+            lines.append("{0}{1}_sum{2} {3!r}".format(prefix, name, format_labels(labels), total))
+        return "\n".join(lines) + "\n"
+
+
+class _Lane(object):
+    def __init__(self, name):
+        self.name = name
+        self.waiting = collections.deque()
+        self.in_flight = 0
+        self.served = 0.0
+
+
+class TransmitLanes(object):
+    """Schedules agent requests over a fixed number of connections by priority lane, see AgentCore.set_lanes.
+
+    When a connection is free, it goes to the oldest request of the highest priority lane waiting; lanes
+    of equal priority share connections by weight. Connections reserved by a lane are never given to
+    lower priority lanes, so latency-sensitive requests don't wait behind bulk uploads already in flight.
+    Requests in flight are never interrupted: a bulk transfer split over several requests yields to
+    waiting higher priority requests between its requests.
+
+    By default:
+    * LANE_INTERACTIVE (service call polling) has priority 2 and reserves 1 connection
+    * LANE_DEFAULT has priority 1
+    * LANE_BULK (chunked variables, outbox) has priority 0
+
+    :param connections: requests in flight at once, across lanes
+    """
+    def __init__(self, connections=DEFAULT_LANE_CONNECTIONS):
+        if connections < 1:
+            raise ValueError("need at least one connection")
+        self.connections = connections
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.lanes = {}
+        self.add_lane(LANE_INTERACTIVE, priority=2, reserved=1)
+        self.add_lane(LANE_DEFAULT, priority=1)
+        self.add_lane(LANE_BULK, priority=0)
+
+    def add_lane(self, name, priority=0, weight=1, slots=None, reserved=0):
+        """Adds a lane, or reconfigures an existing one.
+
+        :param priority: lanes with higher priority are served first
+        :param weight: share of connections among waiting lanes of equal priority
+        :param slots: requests of this lane in flight at once, None for no limit
+        :param reserved: connections kept free for this lane when lower priority lanes are waiting (lower
+                         priority lanes still get one connection)
+        """
+        if weight <= 0:
+            raise ValueError("lane weight must be > 0")
+        with self.condition:
+            lane = self.lanes.get(name)
+            if lane is None:
+                lane = self.lanes[name] = _Lane(name)
+            lane.priority = priority
+            lane.weight = weight
+            lane.slots = self.connections if slots is None else slots
+            lane.reserved = reserved
+            self._dispatch()
+
+    def _eligible(self, lane):
+        if not lane.waiting or lane.in_flight >= lane.slots:
+            return False
+        reserved_above = sum(max(0, other.reserved - other.in_flight) for other in self.lanes.values()
+                             if other.priority > lane.priority)
+        # Every lane may use at least one connection, whatever is reserved
+        return self.connections - self.in_flight > min(reserved_above, self.connections - 1)
+
+    def _dispatch(self):
+        granted = False
+        while self.in_flight < self.connections:
+            eligible = [lane for lane in self.lanes.values() if self._eligible(lane)]
+            if not eligible:
+                break
+            lane = min(eligible, key=lambda lane: (-lane.priority, lane.served))
+            lane.waiting.popleft().set()
+            lane.in_flight += 1
+            lane.served += 1.0 / lane.weight
+            self.in_flight += 1
+            granted = True
+        if granted:
+            self.condition.notify_all()
+
+    def acquire(self, name):
+        """Waits for a connection for a request of lane name.
+
+        :return: seconds waited
+        """
+        start = time.time()
+        granted = threading.Event()
+        with self.condition:
+            lane = self.lanes.get(name)
+            if lane is None:
+                raise ValueError("unknown lane " + str(name))
+            if not lane.waiting and lane.in_flight == 0:
+                # A lane that was idle doesn't get credit for the time it didn't use
+                active = [other.served for other in self.lanes.values()
+                          if other.priority == lane.priority and (other.waiting or other.in_flight)]
+                if active:
+                    lane.served = max(lane.served, min(active))
+            lane.waiting.append(granted)
+            self._dispatch()
+            while not granted.is_set():
+                self.condition.wait()
+        return time.time() - start
+
+    def release(self, name):
+        with self.condition:
+            self.lanes[name].in_flight -= 1
+            self.in_flight -= 1
+            self._dispatch()
+
+
 class NetvendResponseError(BaseException):
     def __init__(self, batch, error_info):  # message, batch, pos_in_batch, already_charged):
         self.batch = batch
@@ -201,6 +579,30 @@ class QueryResult(object):
         if raise_on_truncate and self.truncated:
             raise RuntimeError("query result has been truncated; rows are missing.")
 
+    def freeze(self):
+        """Returns a read-only copy of the result, that can be shared between callers (rows are tuples)."""
+        return FrozenQueryResult(self)
+
+
+class FrozenQueryResult(QueryResult):
+    """Read-only QueryResult, see QueryResult.freeze."""
+    def __init__(self, result):
+        object.__setattr__(self, "rows", tuple(tuple(row) for row in result.rows))
+        object.__setattr__(self, "time_cost", result.time_cost)
+        object.__setattr__(self, "size_cost", result.size_cost)
+        object.__setattr__(self, "truncated", result.truncated)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("QueryResult is shared and read-only")
+
+
+class InFlightQuery(object):
+    """A query being transmitted, that identical concurrent queries wait on (see AgentBasic.set_query_dedup)."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
 
 class QueryBatchResult(BatchResult):
     def __init__(self, response, size, raise_on_truncate):
@@ -243,42 +645,270 @@ class BatchResultList(object):
         return self.results[index]
 
 
+def decode_private(private, privtype):
+    """Converts a private key of any PRIVTYPE_* format to hex.
+
+    :param private: private key
+    :param privtype: private key format, see PRIVTYPE_*
+    :return: private key as a 64 character hex str
+    """
+    if privtype is PRIVTYPE_SEED:
+        return pybitcointools.sha256(private)
+    elif privtype is PRIVTYPE_B58CHECK:
+        try:
+            return pybitcointools.b58check_to_hex(private)
+        except AssertionError:
+            raise ValueError("Invalid private key")
+    elif privtype is PRIVTYPE_HEX:
+        if len(private) == 64:
+            return private
+        else:
+            raise ValueError("Invalid private key")
+    else:
+        raise ValueError("Invalid privtype")
+
+
+def compute_identity(private):
+    """Does the EC work for a hex private key.
+
+    :param private: private key as hex
+    :return: tuple of pubkey (hex) and address
+    """
+    backend = cryptobackend.get_backend()
+    pubkey = backend.privtopub(private)
+    return pubkey, backend.pubkey_to_address(pubkey)
+
+
+class IdentityCache(object):
+    """Maps private key fingerprints to their pubkey and address, so agents can skip EC work.
+
+    The cache is a JSON file. Private keys are only stored if a passphrase is given, and are
+    then encrypted with a key derived from it (PBKDF2-SHA256, then separate keys for the
+    SHA256 keystream and the HMAC-SHA256 tags). With a passphrase every entry is also
+    authenticated, and entries that fail the check are treated as not cached; without one,
+    the file must be trusted.
+
+    :param path: file to persist the cache to, None to keep it in memory only
+    :param passphrase: if given, private keys are stored encrypted and can be read back with load_private
+    """
+    KDF_ROUNDS = 100000
+
+    def __init__(self, path=None, passphrase=None):
+        self.path = path
+        self.entries = {}
+        self.salt = None
+        self.lock = thread.allocate_lock()
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                stored = convert_json_unicode_to_str(json.loads(f.read()))
+            self.entries = stored["identities"]
+            self.salt = stored.get("salt")
+        if self.salt is None:
+            self.salt = os.urandom(16).encode('hex')
+        if passphrase is None:
+            self.key = None
+        else:
+            self.key = hashlib.pbkdf2_hmac('sha256', passphrase, self.salt.decode('hex'), self.KDF_ROUNDS)
+            self.enc_key = hmac.new(self.key, "netvend-identity-enc", hashlib.sha256).digest()
+            self.mac_key = hmac.new(self.key, "netvend-identity-mac", hashlib.sha256).digest()
+
+    @staticmethod
+    def fingerprint(private):
+        return pybitcointools.sha256("netvend-identity:" + private)
+
+    def get(self, private):
+        """Returns (pubkey, address) for a hex private key, or None if it is not cached."""
+        fingerprint = self.fingerprint(private)
+        entry = self.entries.get(fingerprint)
+        if entry is None:
+            return None
+        if self.key is not None and not hmac.compare_digest(str(entry.get("mac", "")), self._entry_mac(fingerprint, entry)):
+            return None
+        return entry["pubkey"], entry["address"]
+
+    def put(self, private, pubkey, address):
+        self.update([(private, pubkey, address)])
+
+    def update(self, identities):
+        """Adds a list of (private, pubkey, address) tuples and saves the cache once."""
+        with self.lock:
+            for private, pubkey, address in identities:
+                fingerprint = self.fingerprint(private)
+                entry = {"pubkey": pubkey, "address": address}
+                if self.key is not None:
+                    entry["private"] = self._encrypt(private)
+                    entry["mac"] = self._entry_mac(fingerprint, entry)
+                self.entries[fingerprint] = entry
+            self.save()
+
+    def load_private(self, fingerprint):
+        """Returns the hex private key stored under fingerprint, or None if it was stored without a passphrase."""
+        if self.key is None:
+            raise ValueError("IdentityCache needs a passphrase to load private keys")
+        entry = self.entries.get(fingerprint)
+        if entry is None or "private" not in entry:
+            return None
+        if not hmac.compare_digest(str(entry.get("mac", "")), self._entry_mac(fingerprint, entry)):
+            raise ValueError("wrong passphrase or corrupted identity cache")
+        return self._decrypt(entry["private"])
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"salt": self.salt, "identities": self.entries}))
+        os.rename(tmp_path, self.path)
+
+    def _entry_mac(self, fingerprint, entry):
+        fields = [fingerprint, entry["pubkey"], entry["address"], entry.get("private", "")]
+        return hmac.new(self.mac_key, json.dumps(fields), hashlib.sha256).hexdigest()
+
+    def _keystream(self, nonce, length):
+        stream = ""
+        counter = 0
+        while len(stream) < length:
+            stream += hashlib.sha256(self.enc_key + nonce + str(counter)).digest()
+            counter += 1
+        return stream[:length]
+
+    def _encrypt(self, private):
+        plain = private.decode('hex')
+        nonce = os.urandom(16)
+        cipher = "".join(chr(ord(a) ^ ord(b)) for a, b in zip(plain, self._keystream(nonce, len(plain))))
+        tag = hmac.new(self.mac_key, nonce + cipher, hashlib.sha256).digest()
+        return (nonce + cipher + tag).encode('hex')
+
+    def _decrypt(self, encrypted):
+        raw = encrypted.decode('hex')
+        nonce, cipher, tag = raw[:16], raw[16:-32], raw[-32:]
+        if not hmac.compare_digest(hmac.new(self.mac_key, nonce + cipher, hashlib.sha256).digest(), tag):
+            raise ValueError("wrong passphrase or corrupted identity cache")
+        return "".join(chr(ord(a) ^ ord(b)) for a, b in zip(cipher, self._keystream(nonce, len(cipher)))).encode('hex')
+
+
 class AgentCore(object):
     """Base class providing a skeleton framework. This should be stable.
 
     :param private: private key
     :param url: url of the netvend server
     :param privtype: private key format, see PRIVTYPE_*
+    :param identity_cache: optional IdentityCache used to skip computing the pubkey and address
     """
-    def __init__(self, private, url, privtype):
-        if privtype is PRIVTYPE_SEED:
-            self.private = pybitcointools.sha256(private)
-        elif privtype is PRIVTYPE_B58CHECK:
+    def __init__(self, private, url, privtype, identity_cache=None):
+        self.private = decode_private(private, privtype)
+
+        identity = None
+        if identity_cache is not None:
+            identity = identity_cache.get(self.private)
+        if identity is None:
+            identity = compute_identity(self.private)
+            if identity_cache is not None:
+                identity_cache.put(self.private, *identity)
+
+        self.pubkey, self.address = identity
+        self.url = url
+        self.metrics = None
+        self.lanes = None
+        self.lane_local = threading.local()
+
+    @classmethod
+    def from_many(cls, privates, privtype=PRIVTYPE_SEED, identity_cache=None, processes=None, **kwargs):
+        """Constructs one agent per private key, computing missing identities in parallel.
+
+        :param privates: list of private keys
+        :param privtype: private key format of every key, see PRIVTYPE_*
+        :param identity_cache: IdentityCache to read and fill, by default a new in-memory one
+        :param processes: number of worker processes, None for one per cpu, 1 to stay in this process
+        :param kwargs: passed on to the constructor (url, ...)
+        :return: list of agents, in the order of privates
+        """
+        if identity_cache is None:
+            identity_cache = IdentityCache()
+        hex_privates = [decode_private(private, privtype) for private in privates]
+
+        missing = []
+        for private in hex_privates:
+            if identity_cache.get(private) is None and private not in missing:
+                missing.append(private)
+
+        if len(missing) > 1 and processes != 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
             try:
-                self.private = pybitcointools.b58check_to_hex(private)
-            except AssertionError:
-                raise ValueError("Invalid private key")
-        elif privtype is PRIVTYPE_HEX:
-            if len(private) == 64:
-                self.private = private
-            else:
-                raise ValueError("Invalid private key")
+                identities = pool.map(compute_identity, missing)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            # Raise a ValueError, otherwise self.private would not be defined
-            raise ValueError("Invalid privtype")
+            identities = [compute_identity(private) for private in missing]
 
-        self.address = pybitcointools.pubkey_to_address(pybitcointools.privtopub(self.private))
-        self.url = url
+        if missing:
+            identity_cache.update([(private,) + tuple(identity) for private, identity in zip(missing, identities)])
+
+        return [cls(private, privtype=PRIVTYPE_HEX, identity_cache=identity_cache, **kwargs) for private in hex_privates]
 
     def get_address(self):
         return self.address
 
+    def set_metrics(self, metrics):
+        """Reports timings and counters to metrics (e.g. an InMemoryMetrics), or None to stop reporting."""
+        self.metrics = metrics
+
+    def set_lanes(self, lanes):
+        """Schedules requests with lanes (a TransmitLanes, which agents may share), or None to send right away."""
+        self.lanes = lanes
+
+    def current_lane(self):
+        return getattr(self.lane_local, "name", LANE_DEFAULT)
+
+    @contextlib.contextmanager
+    def lane(self, name):
+        """Sends the requests this thread makes in the with block in lane name."""
+        previous = self.current_lane()
+        self.lane_local.name = name
+        try:
+            yield
+        finally:
+            self.lane_local.name = previous
+
     def sign_data(self, data):
-        return pybitcointools.ecdsa_sign(data, self.private)
+        if self.metrics is None:
+            return cryptobackend.get_backend().ecdsa_sign(data, self.private)
+        start = time.time()
+        sig = cryptobackend.get_backend().ecdsa_sign(data, self.private)
+        self.metrics.observe("sign_seconds", time.time() - start)
+        return sig
 
     def send_to_netvend(self, arg_dict):
+        if self.lanes is None:
+            return self.send_request(arg_dict)
+
+        lane = self.current_lane()
+        start = time.time()
+        wait = self.lanes.acquire(lane)
+        try:
+            data = self.send_request(arg_dict)
+        finally:
+            self.lanes.release(lane)
+        if self.metrics is not None:
+            labels = {"lane": lane}
+            self.metrics.observe("lane_wait_seconds", wait, labels)
+            self.metrics.observe("lane_seconds", time.time() - start, labels)
+        return data
+
+    def send_request(self, arg_dict):
         new_arg_dict = dict({'version': NETVEND_VERSION}, **arg_dict)
-        return urlopen(self.url, urlencode(new_arg_dict)).read()
+        if self.metrics is None:
+            return urlopen(self.url, urlencode(new_arg_dict)).read()
+
+        encoded = urlencode(new_arg_dict)
+        start = time.time()
+        data = urlopen(self.url, encoded).read()
+        self.metrics.observe("http_seconds", time.time() - start)
+        self.metrics.increment("bytes_out", len(encoded))
+        self.metrics.increment("bytes_in", len(data))
+        return data
 
 
 class AgentBasic(AgentCore):
@@ -287,39 +917,101 @@ class AgentBasic(AgentCore):
     Adds functions for all command types and a function to make server output nicer.
     This should be stable.
     """
-    def __init__(self, private, url=NETVEND_URL, privtype=PRIVTYPE_SEED):
-        super(AgentBasic, self).__init__(private, url, privtype)
+    def __init__(self, private, url=NETVEND_URL, privtype=PRIVTYPE_SEED, identity_cache=None):
+        super(AgentBasic, self).__init__(private, url, privtype, identity_cache)
         self.batches = []
         self.batch_types = []
         self.log_path = None
+        self.journal = None
         self.raise_on_query_truncate = True
-
-    def post_process(self, data, batch_types, batch_sizes):
+        self.inflight_queries = None
+        self.inflight_lock = thread.allocate_lock()
+        self.dedup_hits = 0
+        self.dedup_misses = 0
+        self.outbox = None
+
+    def post_process(self, data, batch_types, batch_sizes, raise_on_truncate=None):
+        start = time.time()
         try:
             responses = json.loads(data)
         except ValueError:
             raise ValueError("Can't parse server response. Server responded with:\n" + data)
+        if self.metrics is not None:
+            self.metrics.observe("parse_seconds", time.time() - start)
                    
         if not responses[-1][0]:
-            if self.log_path is not None:
-                with open(self.log_path + self.get_address() + "_" + str(time.time()), "a") as f:
-                    pickle.dump(responses, f)
+            if self.journal is not None:
+                self.journal.record({"time": time.time(), "address": self.get_address(), "responses": responses})
+            if self.metrics is not None:
+                self.metrics.increment("errors")
             raise NetvendResponseError(len(responses)-1, responses[-1])
         
-        return BatchResultList(responses, batch_types, batch_sizes, raise_on_truncate=self.raise_on_query_truncate)
+        if raise_on_truncate is None:
+            raise_on_truncate = self.raise_on_query_truncate
+        result_list = BatchResultList(responses, batch_types, batch_sizes, raise_on_truncate=raise_on_truncate)
+        if self.metrics is not None:
+            self.record_costs(result_list, batch_types)
+        return result_list
+
+    def record_costs(self, result_list, batch_types):
+        for batch_type, batch_result in zip(batch_types, result_list.results):
+            labels = {"batch_type": BATCHTYPE_NAMES.get(batch_type, batch_type)}
+            self.metrics.increment("charged", batch_result.charged, labels)
+            if batch_type is BATCHTYPE_QUERY:
+                for query_result in batch_result.results:
+                    self.metrics.increment("time_cost", query_result.time_cost)
+                    self.metrics.increment("size_cost", query_result.size_cost)
+                    if query_result.truncated:
+                        self.metrics.increment("truncated_queries")
     
-    def set_log_path(self, log_path):
+    def set_log_path(self, log_path, max_bytes=errorjournal.DEFAULT_MAX_BYTES, backups=errorjournal.DEFAULT_BACKUPS):
+        """Journals failed server responses to the file log_path + address + ".journal", see errorjournal.
+
+        :param log_path: path prefix of the journal, None to stop journaling
+        :param max_bytes: size at which the journal is rotated
+        :param backups: number of rotated journal files kept
+        """
+        journal = None
+        if log_path is not None:
+            # Raises IOError right away if the journal can't be opened
+            journal = errorjournal.ErrorJournal(log_path + self.get_address() + ".journal", max_bytes, backups)
+        if self.journal is not None:
+            self.journal.close()
         self.log_path = log_path
+        self.journal = journal
     
+    def set_query_dedup(self, enabled):
+        """Turns single-flight deduplication of query() on or off.
+
+        When on, identical queries issued while one is already in flight wait for it and share its
+        QueryResult instead of being signed and sent again. Shared results are frozen (read-only, rows
+        are tuples). dedup_hits and dedup_misses count shared and transmitted queries.
+        """
+        with self.inflight_lock:
+            self.inflight_queries = {} if enabled else None
+
+    def set_outbox(self, outbox):
+        """Sets the outbox.Outbox that queue_batches hands batches to, or None."""
+        self.outbox = outbox
+
     def clear_batches(self):
         self.batches = []
         self.batch_types = []
     
-    def add_batch(self, batch):
-        encoded_batch = json.dumps(batch)
+    def sign_batch(self, batch):
+        if self.metrics is None:
+            encoded_batch = json.dumps(batch)
+        else:
+            start = time.time()
+            encoded_batch = json.dumps(batch)
+            self.metrics.observe("serialize_seconds", time.time() - start)
+            self.metrics.increment("commands", len(batch[1]), {"batch_type": BATCHTYPE_NAMES.get(batch[0], batch[0])})
         
         sig = self.sign_data(encoded_batch)
-        signed_batch = [encoded_batch, sig]
+        return [encoded_batch, sig]
+    
+    def add_batch(self, batch):
+        signed_batch = self.sign_batch(batch)
         
         self.batches.append(signed_batch)
         self.batch_types.append(batch[0])
@@ -400,8 +1092,22 @@ class AgentBasic(AgentCore):
         else:
             return thread.start_new_thread(self.transmit_batches_callback, (callback,))
     
-    def transmit_single_batch_blocking(self, batch_type, signed_batch, batch_size):
-        result_list = self.post_process(self.send_to_netvend({"batches": json.dumps([signed_batch])}), [batch_type], [batch_size])
+    def queue_batches(self, block=True, timeout=None):
+        """Hands the added batches to the outbox, which transmits them together in the background.
+
+        :param block: wait for room in the outbox when it is full, instead of raising
+        :param timeout: seconds to wait for room, None to wait forever
+        :return: outbox.OutboxTicket, whose wait() returns the BatchResultList
+        """
+        if self.outbox is None:
+            raise RuntimeError("Need to set an outbox before queuing batches")
+        ticket = self.outbox.submit(self.batches, self.batch_types, block, timeout)
+        self.clear_batches()
+        return ticket
+    
+    def transmit_single_batch_blocking(self, batch_type, signed_batch, batch_size, raise_on_truncate=None):
+        result_list = self.post_process(self.send_to_netvend({"batches": json.dumps([signed_batch])}), [batch_type], [batch_size],
+                                        raise_on_truncate)
         batch_result = result_list[0]
         return batch_result
     
@@ -419,11 +1125,7 @@ class AgentBasic(AgentCore):
             return thread.start_new_thread(self.transmit_single_batch_callback, (batch_type, signed_batch, batch_size, callback))
     
     def sign_and_transmit_single_command_blocking(self, type, command):
-        batch = [type, [command]]
-        encoded_batch = json.dumps(batch)
-        
-        sig = self.sign_data(encoded_batch)
-        signed_batch = [encoded_batch, sig]
+        signed_batch = self.sign_batch([type, [command]])
         
         batch_result = self.transmit_single_batch_blocking(type, signed_batch, 1)
         
@@ -461,7 +1163,62 @@ class AgentBasic(AgentCore):
         if max_size_cost is None:
             max_size_cost = DEFAULT_QUERY_MAX_SIZE_COST
         
-        return self.sign_and_transmit_single_command(BATCHTYPE_QUERY, [query, max_time_cost, max_size_cost], callback)
+        if self.inflight_queries is None or callback is not None:
+            return self.sign_and_transmit_single_command(BATCHTYPE_QUERY, [query, max_time_cost, max_size_cost], callback)
+
+        key = (query, max_time_cost, max_size_cost)
+        with self.inflight_lock:
+            inflight = self.inflight_queries.get(key)
+            is_leader = inflight is None
+            if is_leader:
+                inflight = InFlightQuery()
+                self.inflight_queries[key] = inflight
+                self.dedup_misses += 1
+            else:
+                self.dedup_hits += 1
+        if self.metrics is not None:
+            self.metrics.increment("query_dedup_misses" if is_leader else "query_dedup_hits")
+
+        if is_leader:
+            try:
+                inflight.result = self.sign_and_transmit_single_command_blocking(
+                    BATCHTYPE_QUERY, [query, max_time_cost, max_size_cost]).freeze()
+            except BaseException:
+                inflight.exc_info = sys.exc_info()
+            finally:
+                with self.inflight_lock:
+                    if self.inflight_queries is not None:
+                        self.inflight_queries.pop(key, None)
+                inflight.done.set()
+        else:
+            inflight.done.wait()
+
+        if inflight.exc_info is not None:
+            raise inflight.exc_info[0], inflight.exc_info[1], inflight.exc_info[2]
+        return inflight.result
+    
+    def query_many(self, queries, max_time_cost=None, max_size_cost=None):
+        """Sends several queries as one signed query batch, without touching pending batches.
+
+        :return: list of the rows of each query
+        """
+        return [query_result.rows for query_result in
+                self.query_many_results(queries, max_time_cost, max_size_cost, self.raise_on_query_truncate)]
+
+    def query_many_results(self, queries, max_time_cost=None, max_size_cost=None, raise_on_truncate=False):
+        """Sends several queries as one signed query batch, like query_many.
+
+        :param raise_on_truncate: raise RuntimeError if a result is truncated, instead of returning it
+        :return: list of the QueryResult of each query, see QueryResult.truncated
+        """
+        if max_time_cost is None:
+            max_time_cost = DEFAULT_QUERY_MAX_TIME_COST
+        if max_size_cost is None:
+            max_size_cost = DEFAULT_QUERY_MAX_SIZE_COST
+        
+        signed_batch = self.sign_batch([BATCHTYPE_QUERY, [[query, max_time_cost, max_size_cost] for query in queries]])
+        batch_result = self.transmit_single_batch_blocking(BATCHTYPE_QUERY, signed_batch, len(queries), raise_on_truncate)
+        return batch_result.results
     
     def withdraw(self, amount, address=None, callback=None):
         if address is None:
@@ -514,16 +1271,77 @@ class Service(object):
 
 class ServiceAgent(Agent):
     """Agent used to call and serve services."""
-    def __init__(self, private, url=NETVEND_URL, privtype=PRIVTYPE_SEED):
-        super(ServiceAgent, self).__init__(private, url, privtype)
+    def __init__(self, private, url=NETVEND_URL, privtype=PRIVTYPE_SEED, identity_cache=None):
+        super(ServiceAgent, self).__init__(private, url, privtype, identity_cache)
         self.services = {}
         self.lowest_fee = None
         self.refund_fee = 0
         self.raise_error_local = False
+        self.verifier = None
+        self.mirror = None
+        self.codec = payloadcodec.CODEC_JSON
+        self.codecs_published = False
+        self.service_codecs = {}
+        self.chunk_cache = chunkstore.ChunkCache()
+        self.posted_chunks = chunkstore.KnownHashes()
     
     def set_refund_fee(self, refund_fee):
         self.refund_fee = refund_fee
 
+    def set_verification(self, enabled, cache_size=DEFAULT_SIG_CACHE_SIZE):
+        """Turns end-to-end verification of call and return posts on or off.
+
+        When on, call and return posts this agent makes carry a signature ("s:<sig>:" after the prefix),
+        work only serves calls signed by the address that pulsed, and call only accepts replies signed
+        by the service address. Signed posts are still understood by agents without verification.
+        """
+        if enabled:
+            self.verifier = SignatureVerifier(cache_size)
+        else:
+            self.verifier = None
+
+    def set_codec(self, codec):
+        """Sets the payloadcodec codec used for call args by default (plain JSON unless set).
+
+        call only uses it with services that published it (see publish_codecs), and the closest codec
+        they did publish otherwise; services that published none get plain JSON. A call a service replies
+        to with a decode error is sent again in plain JSON. Services reply in the codec of the call.
+        """
+        if codec not in payloadcodec.supported_codecs():
+            raise ValueError("payload codec {0} is not supported here".format(codec))
+        self.codec = codec
+
+    def publish_codecs(self):
+        """Posts the payloadcodec codecs this agent's services can read, for callers to pick from.
+
+        work and ServicePool publish them before serving calls for the first time.
+        """
+        result = self.post_var_json(CODECS_VAR, payloadcodec.supported_codecs())
+        self.codecs_published = True
+        return result
+
+    def readable_codecs(self, service_address):
+        """Returns the codecs service_address published it can read, plain JSON only if it published none."""
+        if service_address not in self.service_codecs:
+            published = self.fetch_var_json(service_address, CODECS_VAR)
+            if type(published) is not list:
+                published = [payloadcodec.CODEC_JSON]
+            self.service_codecs[service_address] = published
+        return self.service_codecs[service_address]
+
+    def set_mirror(self, mirror):
+        """Answers work, call and fetch_var_json lookups from a localmirror.LocalMirror, or None to query remotely.
+
+        Addresses passed to call and fetch_var_json are watched by the mirror from then on, without
+        fetching their older posts (see LocalMirror.watch_address).
+        """
+        self.mirror = mirror
+
+    def make_post_data(self, prefix, body):
+        if self.verifier is None:
+            return prefix + body
+        return prefix + SIGNED_PREFIX + self.sign_data(prefix + body) + ":" + body
+
     def register_service(self, name, func, fee, is_advanced=False):
         self.services[name] = Service(func, fee, is_advanced)
         if self.lowest_fee is None or fee < self.lowest_fee:
@@ -536,6 +1354,19 @@ class ServiceAgent(Agent):
         # Clear any existing batches
         self.clear_batches()
     
+        rows, calls, outcomes = self.fetch_calls()
+        outcomes = [self.serve_call(call) if outcome is None else outcome for call, outcome in zip(calls, outcomes)]
+        return self.post_results(rows, calls, outcomes)
+
+    def fetch_calls(self):
+        """Fetches the calls to serve since our last lastread post.
+
+        :return: tuple of the fetched rows, the calls, as [pulse_id, pulse_from_address, pulse_value, post_id, sig, body]
+                 lists, and the outcome (see serve_call) of each call already answered, None for calls to serve
+        """
+        if not self.codecs_published:
+            self.publish_codecs()
+
         # We need an inner query that fetches the tip_id our agent has served last (we will update this in a post later)
         # The SQL SUBSTRING method considers the first character position 1 (not 0), so we have to have len(lastread_prefix)+1
         inner_query = "SELECT SUBSTRING(data, " + str(len(LASTREAD_PREFIX)+1) + ", LENGTH(data)) " \
@@ -560,57 +1391,93 @@ class ServiceAgent(Agent):
                 "ORDER BY pulses.pulse_id ASC"
                 
 
-        result = self.query(query)
-        if result.truncated:
-            # Not meant to be a permanent solution
-            # TODO: Implement proper solution
-            raise RuntimeError("query truncated; max_size_cost too low.")
+        if self.mirror is None:
+            result = self.query(query)
+            if result.truncated:
+                # Not meant to be a permanent solution
+                # TODO: Implement proper solution
+                raise RuntimeError("query truncated; max_size_cost too low.")
+            rows = result.rows
+        else:
+            self.mirror.sync()
+            rows = self.mirror.pending_calls(self.get_address(), self.lowest_fee)
 
-        rows = result.rows
-        service_results = []
-        refund_pulses = []
+        calls = []
         for row in rows:
             [pulse_id, pulse_from_address, pulse_value, post_id, data] = row
-            pulse_id = int(pulse_id)
-            pulse_from_address = str(pulse_from_address)
-            pulse_value = int(pulse_value)
-            post_id = int(post_id)
-            data = str(data)
-            try:
-                # Get the name and args of the function, as packed by the call method
-                [name, args] = convert_json_unicode_to_str(json.loads(data[len(CALL_PREFIX):]))
-
-                # Call the service's function
-                if name in self.services:
-                    if self.services[name].is_advanced:
-                        request_info_dict = {'pulse_id': pulse_id,
-                                             'pulse_from_address': pulse_from_address,
-                                             'pulse_value': pulse_value,
-                                             'post_id': post_id}
-                        returned = self.services[name].call(args, request_info_dict)
-                    else:
-                        returned = self.services[name].call(args)
+            sig, body = split_signed(str(data)[len(CALL_PREFIX):])
+            calls.append([int(pulse_id), str(pulse_from_address), int(pulse_value), int(post_id), sig, body])
+
+        outcomes = [None] * len(calls)
+        if self.verifier is not None:
+            # Only serve calls signed by whoever sent the pulse; others get an error reply and a refund
+            valid = self.verifier.verify_batch([(CALL_PREFIX + body, sig, pulse_from_address)
+                                                for [_, pulse_from_address, _, _, sig, body] in calls])
+            outcomes = [None if is_valid else self.error_outcome(call, "call is not signed by the pulse sender")
+                        for call, is_valid in zip(calls, valid)]
+
+        return rows, calls, outcomes
+
+    def serve_call(self, call):
+        """Runs the service a call asks for.
+
+        :param call: call as returned by fetch_calls
+        :return: tuple of the return post (None if there is nothing to post) and the refund value (None for no refund)
+        """
+        [pulse_id, pulse_from_address, pulse_value, post_id, sig, body] = call
+        return_prefix = RETURN_PREFIX + str(post_id) + ":"
+        try:
+            # Get the name and args of the function, as packed by the call method
+            [name, args] = convert_json_unicode_to_str(payloadcodec.decode_payload(body))
+
+            # Call the service's function
+            if name in self.services:
+                if self.services[name].is_advanced:
+                    request_info_dict = {'pulse_id': pulse_id,
+                                         'pulse_from_address': pulse_from_address,
+                                         'pulse_value': pulse_value,
+                                         'post_id': post_id}
+                    returned = self.services[name].call(args, request_info_dict)
                 else:
-                    continue  # Name not registered as a service, skip
+                    returned = self.services[name].call(args)
+            else:
+                return None, None  # Name not registered as a service, skip
 
-                # We only want to post if the function actually returns a value
-                if returned is not None:
-                    return_str = RETURN_PREFIX + str(post_id) + ":" + json.dumps(returned)
-                    service_results.append(return_str)
-            
-            except Exception as e:
-                if self.raise_error_local:
-                    raise
-                    
-                # If there's an error, respond with an error response and send a refund
-                return_str = RETURN_PREFIX + str(post_id) + ":e:" + str(e)
+            # We only want to post if the function actually returns a value
+            if returned is None:
+                return None, None
+            # Reply in the caller's codec, which it has shown it can read
+            return self.make_post_data(return_prefix, payloadcodec.encode_payload(returned, payloadcodec.payload_codec(body))), None
+        
+        except Exception as e:
+            if self.raise_error_local:
+                raise
+            return self.error_outcome(call, str(e))
+
+    def error_outcome(self, call, message):
+        """Returns the outcome (see serve_call) of a call that failed: an error response and a refund."""
+        [pulse_id, pulse_from_address, pulse_value, post_id, sig, body] = call
+        return_str = self.make_post_data(RETURN_PREFIX + str(post_id) + ":", "e:" + message)
+        refund = int(pulse_value) - self.refund_fee
+        # If the refund fee (which should cover netvend fees and processing costs) is too much, don't refund
+        return return_str, (refund if refund > 0 else None)
+
+    def post_results(self, rows, calls, outcomes):
+        """Posts the outcomes of serve_call in order, the refunds and our new lastread placeholder.
+
+        :param rows: rows returned by fetch_calls
+        :param calls: calls returned by fetch_calls
+        :param outcomes: (return post, refund) tuple of each call
+        :return: [post batch result, pulse batch result], each None if not sent
+        """
+        service_results = []
+        refund_pulses = []
+        for call, (return_str, refund) in zip(calls, outcomes):
+            if return_str is not None:
                 service_results.append(return_str)
-
-                refund = int(pulse_value) - self.refund_fee
-                # If the refund fee (which should cover netvend fees and processing costs) is too much, don't refund
-                if refund > 0:
-                    # Tip will refer to the nth post_id in what will be batch 0, our post batch, where n is the position of the error post in the post batch.
-                    refund_pulses.append([pulse_from_address, refund, len(service_results)-1, 0])
+            if refund is not None:
+                # Tip will refer to the nth post_id in what will be batch 0, our post batch, where n is the position of the error post in the post batch.
+                refund_pulses.append([call[1], refund, len(service_results)-1, 0])
         
         if len(rows) > 0:
             # Get the pulse id of the last row checked
@@ -637,21 +1504,26 @@ class ServiceAgent(Agent):
         else:
             return [None, None]
     
-    def call(self, service_address, service_name, args, value, timeout=None, wait_for_response=True, convert_unicode_to_str=True):
+    def call(self, service_address, service_name, args, value, timeout=None, wait_for_response=True, convert_unicode_to_str=True, codec=None):
         if type(args) is not list and type(args) is not dict:
             raise TypeError("args must be a list")
         # Clear any existing batches
         self.clear_batches()
         
-        # First, make a post to call the service
-        call_str = CALL_PREFIX + json.dumps([service_name, args])
+        # First, make a post to call the service, in a codec it can read
+        if codec is None:
+            codec = self.codec
+        if codec != payloadcodec.CODEC_JSON:
+            codec = payloadcodec.best_codec(codec, self.readable_codecs(service_address))
+        call_str = self.make_post_data(CALL_PREFIX, payloadcodec.encode_payload([service_name, args], codec))
         post_batch_iter = self.add_post_batch([call_str])
 
         # Then use a pulse to alert service_address of our call post
         pulse_batch_iter = self.add_pulse_batch([[service_address, value, 0, post_batch_iter]])
 
         # Send the query, post, and tip batches
-        response_list = self.transmit_batches()
+        with self.lane(LANE_INTERACTIVE):
+            response_list = self.transmit_batches()
         
         if not wait_for_response:
             #return information about pulse and post results instead
@@ -662,6 +1534,10 @@ class ServiceAgent(Agent):
         # Also use the post_id as our initial value for last_post_checked_id, which is needed to check each time for *new* posts
         last_checked_post_id = post_id
 
+        if self.mirror is not None:
+            # Replies can only come after our call, so there's no need to fetch older posts of the service
+            self.mirror.watch_address(service_address, since_post_id=post_id)
+
         start_time = time.time()
         
         # We have to get two values from netvend:
@@ -675,25 +1551,56 @@ class ServiceAgent(Agent):
             # The query that requests new posts changes where it searches from (last_post_checked_id),
             # so we'll define it each loop
             
-            response_check_query = "SELECT data FROM posts WHERE post_id > " + str(last_checked_post_id) + " AND address = '" + service_address + "' AND data LIKE '" + RETURN_PREFIX + str(post_id) + ":%' LIMIT 1"
+            return_prefix = RETURN_PREFIX + str(post_id) + ":"
+            response_check_query = "SELECT post_id, data FROM posts WHERE post_id > " + str(last_checked_post_id) + " AND address = '" + service_address + "' AND data LIKE '" + return_prefix + "%'"
+            if self.verifier is None:
+                response_check_query += " LIMIT 1"
+            else:
+                # Fetch several candidates, in case some are not signed by the service
+                response_check_query += " ORDER BY post_id ASC LIMIT " + str(DEFAULT_VERIFY_CANDIDATES)
         
-            # Add a query batch with both of our queries
-            self.add_query_batch([response_check_query, last_post_id_query])
-            
-            # Send all batches (which is just our one query batch)
-            responses = self.transmit_batches()
-            query_batch_response = responses[0]
-
-            last_checked_post_id = query_batch_response[1].rows[0][0]
-            response_rows = query_batch_response[0].rows
+            if self.mirror is None:
+                # Add a query batch with both of our queries
+                self.add_query_batch([response_check_query, last_post_id_query])
+                
+                # Send all batches (which is just our one query batch)
+                with self.lane(LANE_INTERACTIVE):
+                    responses = self.transmit_batches()
+                query_batch_response = responses[0]
 
-            if len(response_rows) > 0:
-                data = response_rows[0][0]
-                if data.split(':')[2] == "e":
-                    error = data.split(':')[3]
-                    raise RuntimeError("Error in serving script: " + error)
+                candidates = query_batch_response[0].rows
+                newest_post_id = query_batch_response[1].rows[0][0]
+            else:
+                with self.lane(LANE_INTERACTIVE):
+                    self.mirror.sync()
+                candidates = self.mirror.posts_after(service_address, return_prefix, last_checked_post_id,
+                                                     1 if self.verifier is None else DEFAULT_VERIFY_CANDIDATES)
+                newest_post_id = max(last_checked_post_id, self.mirror.last_post_id)
+
+            if self.verifier is not None and len(candidates) == DEFAULT_VERIFY_CANDIDATES:
+                # There may be more candidates after these, only skip the ones we've checked
+                last_checked_post_id = candidates[-1][0]
+            else:
+                last_checked_post_id = newest_post_id
+
+            replies = [split_signed(str(data)[len(return_prefix):]) for candidate_post_id, data in candidates]
+            if self.verifier is not None:
+                valid = self.verifier.verify_batch([(return_prefix + body, sig, service_address) for sig, body in replies])
+                replies = [reply for reply, is_valid in zip(replies, valid) if is_valid]
+
+            if len(replies) > 0:
+                body = replies[0][1]
+                if body.startswith("e:"):
+                    if codec != payloadcodec.CODEC_JSON and payloadcodec.is_decode_error(body[len("e:"):]):
+                        # The service can't read the codec after all, call again in plain JSON
+                        self.service_codecs[service_address] = [payloadcodec.CODEC_JSON]
+                        if timeout is not None:
+                            timeout = max(0, timeout - (time.time() - start_time))
+                        return self.call(service_address, service_name, args, value, timeout, wait_for_response,
+                                         convert_unicode_to_str, payloadcodec.CODEC_JSON)
+                    raise RuntimeError("Error in serving script: " + body[len("e:"):])
                     
-                decoded = json.loads(data[len(RETURN_PREFIX)+len(str(post_id)+":"):])
+                decoded = payloadcodec.decode_payload(body)
                 if convert_unicode_to_str:
                     decoded = convert_json_unicode_to_str(decoded)
                 return decoded
@@ -715,13 +1622,117 @@ class ServiceAgent(Agent):
         
         return self.post(data)
     
+    def fetch_latest_post_data(self, address, prefix, max_size_cost=DEFAULT_QUERY_MAX_SIZE_COST):
+        """Returns the data after prefix of the newest post by address starting with prefix, or None."""
+        if self.mirror is None:
+            query_result = self.query("SELECT SUBSTRING(data, " + str(len(prefix)+1) + ", LENGTH(data)) FROM posts WHERE address = '" + address + "' AND data LIKE '"+prefix+"%' ORDER BY post_id DESC LIMIT 1", max_size_cost=max_size_cost)
+            if len(query_result.rows) == 0:
+                return None
+            return query_result.rows[0][0]
+        else:
+            self.mirror.watch_address(address)
+            self.mirror.sync()
+            data = self.mirror.latest_post_data(address, prefix)
+            if data is None:
+                return None
+            return data[len(prefix):]
+    
     def fetch_var_json(self, address, name, max_size_cost=DEFAULT_QUERY_MAX_SIZE_COST, convert_unicode_to_str=True):
         prefix = "v:json:"+name+":"
         
-        query_result = self.query("SELECT SUBSTRING(data, " + str(len(prefix)+1) + ", LENGTH(data)) FROM posts WHERE address = '" + address + "' AND data LIKE '"+prefix+"%' ORDER BY post_id DESC LIMIT 1", max_size_cost=max_size_cost)
-        if len(query_result.rows) == 0:
+        encoded = self.fetch_latest_post_data(address, prefix, max_size_cost)
+        if encoded is None:
+            return None
+        
+        try:
+            decoded = json.loads(encoded)
+        except ValueError:
+            raise RuntimeError("error in decoding fetched object")
+        
+        if convert_unicode_to_str:
+            decoded = convert_json_unicode_to_str(decoded)
+            
+        return decoded
+
+    def set_chunk_cache(self, cache):
+        """Sets the chunkstore.ChunkCache that chunked variables are read from and stored in.
+
+        The default cache keeps at most chunkstore.DEFAULT_CACHE_BYTES of chunks in memory.
+        """
+        self.chunk_cache = cache
+
+    def post_var_chunked(self, name, obj):
+        """Posts a variable as content-addressed chunks plus a manifest, see chunkstore.
+
+        Chunks this agent has already posted are not posted again, so rewriting a large
+        variable after a small change only costs the changed chunks.
+
+        :return: PostBatchResult of the batch of new chunks and the manifest
+        """
+        try:
+            encoded = json.dumps(obj)
+        except TypeError:
+            raise ValueError('object is not json-serializable')
+        
+        chunks = chunkstore.split_chunks(encoded)
+        hashes = [chunkstore.chunk_hash(chunk) for chunk in chunks]
+        
+        # Ask the server which of the chunks we don't know about have been posted already
+        unknown = sorted(h for h in set(hashes) if h not in self.posted_chunks)
+        if unknown:
+            # One bounded query per group of hashes, so neither the SQL nor a result grows with the variable
+            start = len(chunkstore.CHUNK_PREFIX) + 1
+            groups = [unknown[i:i + chunkstore.DEFAULT_HASHES_PER_LOOKUP]
+                      for i in range(0, len(unknown), chunkstore.DEFAULT_HASHES_PER_LOOKUP)]
+            results = self.query_many(["SELECT DISTINCT SUBSTRING(data, " + str(start) + ", 64) FROM posts "
+                                       "WHERE address = '" + self.get_address() + "' "
+                                       "AND SUBSTRING(data, 1, " + str(start + 63) + ") IN (" +
+                                       ",".join("'" + chunkstore.CHUNK_PREFIX + h + "'" for h in group) + ")"
+                                       for group in groups])
+            for rows in results:
+                self.posted_chunks.update(str(row[0]) for row in rows)
+        
+        posts = []
+        new_hashes = set()
+        for h, chunk in zip(hashes, chunks):
+            self.chunk_cache.put(h, chunk)
+            if h not in self.posted_chunks and h not in new_hashes:
+                posts.append(chunkstore.CHUNK_PREFIX + h + ":" + chunk)
+                new_hashes.add(h)
+        posts.append(chunkstore.MANIFEST_PREFIX + name + ":" + chunkstore.make_manifest(encoded, chunks))
+        
+        signed_batch = self.sign_batch([BATCHTYPE_POST, posts])
+        with self.lane(LANE_BULK):
+            result = self.transmit_single_batch_blocking(BATCHTYPE_POST, signed_batch, len(posts))
+        self.posted_chunks.update(new_hashes)
+        return result
+
+    def query_many_bulk(self, queries):
+        """query_many in the bulk lane, from any thread."""
+        with self.lane(LANE_BULK):
+            return self.query_many(queries)
+
+    def iter_var_chunked(self, address, name, workers=chunkstore.DEFAULT_FETCH_WORKERS):
+        """Yields the JSON text of a chunked variable chunk by chunk, or nothing if it doesn't exist.
+
+        Missing chunks are fetched in parallel query batches, verified and added to the chunk cache.
+        """
+        encoded_manifest = self.fetch_latest_post_data(address, chunkstore.MANIFEST_PREFIX + name + ":")
+        if encoded_manifest is None:
+            return
+        manifest = chunkstore.parse_manifest(encoded_manifest)
+        for chunk in chunkstore.iter_chunks(self.query_many_bulk, address, manifest["chunks"], self.chunk_cache, workers):
+            yield chunk
+
+    def fetch_var_chunked(self, address, name, workers=chunkstore.DEFAULT_FETCH_WORKERS, convert_unicode_to_str=True):
+        """Fetches a variable posted with post_var_chunked, or None if it doesn't exist."""
+        encoded_manifest = self.fetch_latest_post_data(address, chunkstore.MANIFEST_PREFIX + name + ":")
+        if encoded_manifest is None:
             return None
-        encoded = query_result.rows[0][0]
+        manifest = chunkstore.parse_manifest(encoded_manifest)
+        encoded = "".join(chunkstore.iter_chunks(self.query_many_bulk, address, manifest["chunks"], self.chunk_cache, workers))
+        if chunkstore.chunk_hash(encoded) != manifest["hash"]:
+            raise RuntimeError("chunked variable does not match its manifest")
         
         try:
             decoded = json.loads(encoded)
@@ -731,4 +1742,4 @@ class ServiceAgent(Agent):
         if convert_unicode_to_str:
             decoded = convert_json_unicode_to_str(decoded)
             
-        return decoded
\ No newline at end of file
+        return decoded
@@ -0,0 +1,398 @@
+"""
+outbox - A bounded, durable queue of signed batches, transmitted by a background sender.
+
+Batches queued with AgentBasic.queue_batches are written to the outbox (an
+sqlite file, or memory) before queue_batches returns, so a crash between
+signing and transmitting doesn't lose them. A background thread sends pending
+groups together, as few requests as max_batches_per_request allows. When
+max_pending groups are waiting, queuing blocks until the sender catches up.
+
+A group is the batches of one queue_batches call. Pulses can refer to a post
+batch by its position in the request, so a group with such pulses is always
+sent at the start of a request, and groups are never split across requests.
+
+A request that couldn't be opened (URLError) never reached the server, and is
+simply sent again. A group whose request was sent but not answered (the
+connection failed midway, or the process died) may have been applied by the
+server. Resending it could spend pulses twice, so the sender first looks for
+its commands among the agent's posts and pulses newer than the ones it had
+seen before sending (posts by data, pulses by recipient, value and post_id):
+* all found: the group was applied, its ticket completes without results
+* none found: the group is sent again
+* some found, or a withdrawal: the group is held, see held() and release()
+Query batches are not looked for; groups of queries only are simply sent again.
+A post or pulse identical to one of the group's, made by the same agent outside
+the outbox after the group was sent, is taken for the group's.
+
+    outbox = Outbox(agent, "outbox.sqlite")
+    agent.set_outbox(outbox)
+    agent.add_post_batch(["hello"])
+    ticket = agent.queue_batches()
+    result_list = ticket.wait()
+"""
+
+import json
+import time
+import urllib2
+import sqlite3
+import threading
+import netvendtk
+
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_MAX_BATCHES_PER_REQUEST = 32
+DEFAULT_LINGER = 0.01
+DEFAULT_RETRY_INTERVAL = 1.0
+DEFAULT_POSTS_PER_CHECK = 100
+
+STATE_PENDING = "pending"
+STATE_SENDING = "sending"
+STATE_DOUBT = "doubt"
+STATE_HELD = "held"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (entry_id INTEGER PRIMARY KEY, batches TEXT, batch_types TEXT, batch_sizes TEXT,
+                                   anchored INTEGER, state TEXT, error TEXT);
+CREATE TABLE IF NOT EXISTS marks (name TEXT PRIMARY KEY, value INTEGER);
+"""
+
+
+def quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def was_not_sent(error):
+    """Returns True for request errors raised before the request reached the server."""
+    return isinstance(error, urllib2.URLError) and not isinstance(error, urllib2.HTTPError)
+
+
+class OutboxTicket(object):
+    """Completion of a queued group.
+
+    result is the BatchResultList of the group's batches, or None if the group was found applied after
+    its response was lost. error is the exception the group failed with, if any.
+    """
+    def __init__(self, entry_id):
+        self.entry_id = entry_id
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """Waits for the group to be sent, returns its result or raises its error."""
+        if not self.done.wait(timeout):
+            raise RuntimeError("outbox entry {0} not sent yet".format(self.entry_id))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Entry(object):
+    def __init__(self, row):
+        self.entry_id, batches, batch_types, batch_sizes, self.anchored, self.state = row
+        self.batches = json.loads(batches)
+        self.batch_types = json.loads(batch_types)
+        self.batch_sizes = json.loads(batch_sizes)
+
+
+class Outbox(object):
+    """Durable queue of signed batch groups, sent by a background thread through agent.
+
+    :param agent: AgentBasic that signed the batches and sends them
+    :param db_path: sqlite database path; groups left in a reopened outbox are sent again
+    :param max_pending: groups waiting to be sent before queuing blocks
+    :param max_batches_per_request: batches sent in one request at most (a larger group is sent alone)
+    :param linger: seconds the sender waits for more groups before sending a small request
+    :param retry_interval: seconds between retries after a failed request
+    :param lane: lane of the sender's requests, see netvendtk.TransmitLanes
+    """
+    def __init__(self, agent, db_path=":memory:", max_pending=DEFAULT_MAX_PENDING,
+                 max_batches_per_request=DEFAULT_MAX_BATCHES_PER_REQUEST, linger=DEFAULT_LINGER,
+                 retry_interval=DEFAULT_RETRY_INTERVAL, lane=netvendtk.LANE_BULK):
+        self.agent = agent
+        self.max_pending = max_pending
+        self.max_batches_per_request = max_batches_per_request
+        self.linger = linger
+        self.retry_interval = retry_interval
+        self.lane = lane
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.condition = threading.Condition()
+        self.tickets = {}
+        self.requests = 0
+        self.stopping = False
+
+        # Requests that were in flight when the outbox was last closed may have been applied
+        self.db.execute("UPDATE outbox SET state = ? WHERE state = ?", (STATE_DOUBT, STATE_SENDING))
+        self.db.commit()
+
+        self.sender = threading.Thread(target=self._send_loop)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def _count(self, *states):
+        return self.db.execute("SELECT COUNT(*) FROM outbox WHERE state IN (" + ",".join("?" * len(states)) + ")",
+                               states).fetchone()[0]
+
+    def pending(self):
+        """Returns the number of groups not sent yet, or waiting to be checked."""
+        with self.condition:
+            return self._count(STATE_PENDING, STATE_SENDING, STATE_DOUBT)
+
+    def submit(self, signed_batches, batch_types, block=True, timeout=None):
+        """Queues signed batches to be sent together, in order.
+
+        :param signed_batches: batches signed by AgentBasic.sign_batch
+        :param batch_types: BATCHTYPE_* of each batch
+        :param block: wait for room when max_pending groups are waiting, instead of raising
+        :param timeout: seconds to wait for room, None to wait forever
+        :return: OutboxTicket of the group
+        :raise RuntimeError: if there is no room
+        """
+        if len(signed_batches) == 0:
+            raise ValueError("no batches to queue")
+        commands = [json.loads(encoded_batch)[1] for encoded_batch, sig in signed_batches]
+        anchored = any(batch_type == netvendtk.BATCHTYPE_PULSE and any(len(pulse) > 3 for pulse in pulses)
+                       for batch_type, pulses in zip(batch_types, commands))
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self._count(STATE_PENDING, STATE_SENDING, STATE_DOUBT) >= self.max_pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if self.stopping or not block or (remaining is not None and remaining <= 0):
+                    raise RuntimeError("outbox is full")
+                self.condition.wait(remaining)
+
+            entry_id = self.db.execute("INSERT INTO outbox (batches, batch_types, batch_sizes, anchored, state) "
+                                       "VALUES (?, ?, ?, ?, ?)",
+                                       (json.dumps(signed_batches), json.dumps(batch_types),
+                                        json.dumps([len(c) for c in commands]), int(anchored), STATE_PENDING)).lastrowid
+            self.db.commit()
+            ticket = OutboxTicket(entry_id)
+            self.tickets[entry_id] = ticket
+            self.condition.notify_all()
+        return ticket
+
+    def flush(self, timeout=None):
+        """Waits until every group has been sent (or held).
+
+        :return: False if groups are still waiting after timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self._count(STATE_PENDING, STATE_SENDING, STATE_DOUBT) > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self):
+        """Stops the sender after its current request. Unsent groups stay in the outbox for the next run."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.sender.join()
+        self.db.close()
+
+    def held(self):
+        """Returns [entry_id, error] of the groups held because they may have been (partially) applied."""
+        with self.condition:
+            return [list(row) for row in self.db.execute("SELECT entry_id, error FROM outbox WHERE state = ? "
+                                                         "ORDER BY entry_id", (STATE_HELD,))]
+
+    def release(self, entry_id, resend=False, recheck=False):
+        """Resolves a held group: sends it again, checks the server's history for it again, or drops it."""
+        with self.condition:
+            if recheck:
+                self.db.execute("UPDATE outbox SET state = ?, error = NULL WHERE entry_id = ? AND state = ?",
+                                (STATE_DOUBT, entry_id, STATE_HELD))
+            elif resend:
+                self.db.execute("UPDATE outbox SET state = ?, error = NULL WHERE entry_id = ? AND state = ?",
+                                (STATE_PENDING, entry_id, STATE_HELD))
+            else:
+                self.db.execute("DELETE FROM outbox WHERE entry_id = ? AND state = ?", (entry_id, STATE_HELD))
+            self.db.commit()
+            self.condition.notify_all()
+
+    def _entries(self, state):
+        return [_Entry(row) for row in self.db.execute(
+            "SELECT entry_id, batches, batch_types, batch_sizes, anchored, state FROM outbox WHERE state = ? "
+            "ORDER BY entry_id", (state,))]
+
+    def _set_state(self, entries, state, error=None):
+        self.db.executemany("UPDATE outbox SET state = ?, error = ? WHERE entry_id = ?",
+                            [(state, error, entry.entry_id) for entry in entries])
+
+    def _finish(self, entry, result=None, error=None):
+        self.db.execute("DELETE FROM outbox WHERE entry_id = ?", (entry.entry_id,))
+        ticket = self.tickets.pop(entry.entry_id, None)
+        if ticket is not None:
+            ticket.result = result
+            ticket.error = error
+            ticket.done.set()
+
+    def _next_request(self):
+        """Marks the next groups to send as sending and returns them, waiting for some if there are none."""
+        with self.condition:
+            while not self.stopping and self._count(STATE_PENDING, STATE_DOUBT) == 0:
+                self.condition.wait()
+            if self.stopping:
+                return None, []
+            if self._count(STATE_DOUBT) > 0:
+                return STATE_DOUBT, self._entries(STATE_DOUBT)
+
+        # Give concurrent callers a moment to queue more groups for the same request
+        if self.linger:
+            time.sleep(self.linger)
+
+        with self.condition:
+            request = []
+            size = 0
+            for entry in self._entries(STATE_PENDING):
+                if request and (entry.anchored or size + len(entry.batches) > self.max_batches_per_request):
+                    break
+                request.append(entry)
+                size += len(entry.batches)
+            self._set_state(request, STATE_SENDING)
+            self.db.commit()
+            return STATE_PENDING, request
+
+    def _send_loop(self):
+        while True:
+            state, entries = self._next_request()
+            if state is None:
+                return
+            sent = False
+            try:
+                with self.agent.lane(self.lane):
+                    if state == STATE_DOUBT:
+                        self._resolve(entries)
+                    else:
+                        self._load_marks()
+                        sent = True
+                        self._send(entries)
+            except (Exception, netvendtk.NetvendResponseError) as e:
+                # Connection or server failure: retry later, checking the server first if the request may have arrived
+                with self.condition:
+                    if state == STATE_PENDING:
+                        self._set_state(entries, STATE_DOUBT if sent and not was_not_sent(e) else STATE_PENDING)
+                        self.db.commit()
+                    self.condition.wait(self.retry_interval)
+
+    def _mark(self, name):
+        row = self.db.execute("SELECT value FROM marks WHERE name = ?", (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _raise_mark(self, name, value):
+        if value is not None and value > self._mark(name):
+            self.db.execute("INSERT OR REPLACE INTO marks (name, value) VALUES (?, ?)", (name, value))
+
+    def _load_marks(self):
+        """Records the newest post_id and pulse_id before the first request, groups sent after are newer."""
+        with self.condition:
+            if self.db.execute("SELECT COUNT(*) FROM marks").fetchone()[0] == 2:
+                return
+        posts, pulses = self.agent.query_many(["SELECT MAX(post_id) FROM posts", "SELECT MAX(pulse_id) FROM pulses"])
+        with self.condition:
+            self.db.executemany("INSERT OR IGNORE INTO marks (name, value) VALUES (?, ?)",
+                                [("post_id", int(posts[0][0] or 0)), ("pulse_id", int(pulses[0][0] or 0))])
+            self.db.commit()
+
+    def _send(self, entries):
+        signed_batches = []
+        for entry in entries:
+            signed_batches.extend(entry.batches)
+        data = self.agent.send_to_netvend({"batches": json.dumps(signed_batches)})
+        responses = json.loads(data)
+        self.requests += 1
+        ok_count = len(responses) if responses[-1][0] else len(responses) - 1
+        if not responses[-1][0] and self.agent.journal is not None:
+            self.agent.journal.record({"time": time.time(), "address": self.agent.get_address(), "responses": responses})
+
+        with self.condition:
+            offset = 0
+            for entry in entries:
+                end = offset + len(entry.batches)
+                if end <= ok_count:
+                    try:
+                        result_list = netvendtk.BatchResultList(responses[offset:end], entry.batch_types,
+                                                                entry.batch_sizes, self.agent.raise_on_query_truncate)
+                        if self.agent.metrics is not None:
+                            self.agent.record_costs(result_list, entry.batch_types)
+                        for batch_type, batch_result in zip(entry.batch_types, result_list.results):
+                            if batch_result.size == 0:
+                                continue
+                            if batch_type == netvendtk.BATCHTYPE_POST:
+                                self._raise_mark("post_id", batch_result.first_post_id + batch_result.size - 1)
+                            elif batch_type == netvendtk.BATCHTYPE_PULSE:
+                                self._raise_mark("pulse_id", batch_result.first_pulse_id + batch_result.size - 1)
+                        self._finish(entry, result=result_list)
+                    except Exception as e:
+                        self._finish(entry, error=e)
+                elif offset < len(responses):
+                    # The server stopped at one of this group's batches
+                    self._finish(entry, error=netvendtk.NetvendResponseError(len(responses) - 1 - offset, responses[-1]))
+                else:
+                    # Not reached by the server, send with the next request
+                    self._set_state([entry], STATE_PENDING)
+                offset = end
+            self.db.commit()
+            self.condition.notify_all()
+
+    def _check_queries(self, batch_type, commands):
+        """Returns [query, count] pairs: the batch was applied if every query counts at least count rows."""
+        address = quote(self.agent.get_address())
+        if batch_type == netvendtk.BATCHTYPE_POST:
+            datas = sorted(set(commands))
+            return [["SELECT COUNT(DISTINCT data) FROM posts WHERE address = " + address +
+                     " AND post_id > " + str(self._mark("post_id")) +
+                     " AND data IN (" + ",".join(quote(data) for data in group) + ")", len(group)]
+                    for group in [datas[i:i + DEFAULT_POSTS_PER_CHECK]
+                                  for i in range(0, len(datas), DEFAULT_POSTS_PER_CHECK)]]
+        counts = {}
+        for pulse in commands:
+            # Pulses anchored to a post of the request are matched without their post_id
+            post_id = pulse[2] if len(pulse) > 2 and len(pulse) < 4 and pulse[2] else None
+            key = (pulse[0], pulse[1], post_id)
+            counts[key] = counts.get(key, 0) + 1
+        return [["SELECT COUNT(*) FROM pulses WHERE from_address = " + address +
+                 " AND pulse_id > " + str(self._mark("pulse_id")) + " AND to_address = " + quote(to_address) +
+                 " AND value = " + str(int(value)) + ("" if post_id is None else " AND post_id = " + str(int(post_id))),
+                 count] for (to_address, value, post_id), count in sorted(counts.items())]
+
+    def _resolve(self, entries):
+        """Looks for the posts and pulses of groups that may have been applied, and finishes, resends or holds them."""
+        checks = []
+        with self.condition:
+            for entry in entries:
+                entry.checks = []
+                entry.withdraws = False
+                for (encoded_batch, sig), batch_type in zip(entry.batches, entry.batch_types):
+                    if batch_type == netvendtk.BATCHTYPE_WITHDRAW:
+                        entry.withdraws = True
+                    elif batch_type != netvendtk.BATCHTYPE_QUERY:
+                        batch_checks = self._check_queries(batch_type, json.loads(encoded_batch)[1])
+                        entry.checks.append(range(len(checks), len(checks) + len(batch_checks)))
+                        checks.extend(batch_checks)
+        results = []
+        if checks:
+            results = self.agent.query_many([query for query, count in checks])
+        applied = [int(rows[0][0]) >= count for rows, (query, count) in zip(results, checks)]
+        found_any = [int(rows[0][0]) > 0 for rows in results]
+
+        with self.condition:
+            for entry in entries:
+                if entry.withdraws:
+                    self._set_state([entry], STATE_HELD, "withdrawals can't be looked for on the server")
+                    continue
+                found = [all(applied[i] for i in batch) for batch in entry.checks]
+                touched = [any(found_any[i] for i in batch) for batch in entry.checks]
+                if found and all(found):
+                    self._finish(entry)
+                elif not any(touched):
+                    self._set_state([entry], STATE_PENDING)
+                else:
+                    self._set_state([entry], STATE_HELD, "some commands were found, {0} of {1} batches fully".format(
+                        sum(found), len(found)))
+            self.db.commit()
+            self.condition.notify_all()
@@ -0,0 +1,116 @@
+"""
+payloadcodec - Compact encodings for service call and return payloads.
+
+netvend charges by post size, so ServiceAgent can send call args and results
+compressed instead of as plain JSON. A compact payload starts with a versioned
+codec id, which can't be confused with JSON or the "e:"/"s:" markers:
+* "z1:" + base64(zlib(JSON))
+* "m1:" + base64(zlib(msgpack)), only if the msgpack package is installed
+
+Payloads without a codec id are plain JSON, as sent by agents that predate codecs.
+encode_payload falls back to plain JSON whenever the compact form would not be
+smaller, and to z1 when msgpack is not installed. Python 2's base64 module has
+no base85, so payloads are base64-armored.
+
+Services publish the codecs they can read (ServiceAgent.publish_codecs), and
+callers only send compact payloads in one of them. is_decode_error recognizes
+the error replies of services that couldn't decode a call anyway.
+"""
+
+import json
+import zlib
+import base64
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_JSON = "json"
+CODEC_ZLIB_JSON = "z1"
+CODEC_ZLIB_MSGPACK = "m1"
+
+COMPRESSION_LEVEL = 9
+
+DECODE_ERROR = "can't decode payload"
+# What services that predate codecs reply to a compact call
+LEGACY_DECODE_ERROR = "No JSON object could be decoded"
+
+
+def supported_codecs():
+    """Returns the codecs this interpreter can encode and decode."""
+    codecs = [CODEC_JSON, CODEC_ZLIB_JSON]
+    if msgpack is not None:
+        codecs.append(CODEC_ZLIB_MSGPACK)
+    return codecs
+
+
+def is_decode_error(message):
+    """Returns True if a service error message says the call payload couldn't be decoded."""
+    return message.startswith(DECODE_ERROR) or message == LEGACY_DECODE_ERROR
+
+
+def best_codec(codec, readable):
+    """Returns codec if a service that reads the codecs readable can read it, else the closest one it can."""
+    if codec in readable:
+        return codec
+    if codec == CODEC_ZLIB_MSGPACK and CODEC_ZLIB_JSON in readable:
+        return CODEC_ZLIB_JSON
+    return CODEC_JSON
+
+
+def payload_codec(body):
+    """Returns the codec a payload was encoded with."""
+    for codec in (CODEC_ZLIB_JSON, CODEC_ZLIB_MSGPACK):
+        if body.startswith(codec + ":"):
+            return codec
+    return CODEC_JSON
+
+
+def encode_payload(obj, codec=CODEC_JSON):
+    """Encodes a JSON-serializable object as a post payload.
+
+    :param obj: object to encode
+    :param codec: preferred codec, see CODEC_*
+    :return: payload str; plain JSON if the codec is unavailable or would not save space
+    """
+    encoded = json.dumps(obj)
+    if codec == CODEC_JSON:
+        return encoded
+    if codec == CODEC_ZLIB_MSGPACK and msgpack is None:
+        codec = CODEC_ZLIB_JSON
+
+    if codec == CODEC_ZLIB_MSGPACK:
+        packed = msgpack.packb(obj)
+    elif codec == CODEC_ZLIB_JSON:
+        packed = encoded
+    else:
+        raise ValueError("unknown payload codec {0}".format(codec))
+
+    compact = codec + ":" + base64.b64encode(zlib.compress(packed, COMPRESSION_LEVEL))
+    if len(compact) >= len(encoded):
+        return encoded
+    return compact
+
+
+def decode_payload(body):
+    """Decodes a payload made by encode_payload, or plain JSON.
+
+    :raise ValueError: if the payload can't be decoded, with a message starting with DECODE_ERROR
+    """
+    codec = payload_codec(body)
+    try:
+        if codec == CODEC_JSON:
+            return json.loads(body)
+
+        try:
+            packed = zlib.decompress(base64.b64decode(body[len(codec) + 1:]))
+        except (TypeError, zlib.error) as e:
+            raise ValueError("corrupt {0} payload: {1}".format(codec, e))
+        if codec == CODEC_ZLIB_JSON:
+            return json.loads(packed)
+        if msgpack is None:
+            raise ValueError("payload needs msgpack, which is not installed")
+        return msgpack.unpackb(packed)
+    except ValueError as e:
+        raise ValueError("{0}: {1}".format(DECODE_ERROR, e))
@@ -22,13 +22,21 @@ def inv(a,n):
 
 ### Base switching
 
+# Code strings are built on first use and kept, base 256 in particular
+
+_code_strings = {}
+
 def get_code_string(base):
-   if base == 2: return '01'
-   elif base == 10: return '0123456789'
-   elif base == 16: return "0123456789abcdef"
-   elif base == 58: return "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
-   elif base == 256: return ''.join([chr(x) for x in range(256)])
+   code_string = _code_strings.get(base)
+   if code_string is not None: return code_string
+   if base == 2: code_string = '01'
+   elif base == 10: code_string = '0123456789'
+   elif base == 16: code_string = "0123456789abcdef"
+   elif base == 58: code_string = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+   elif base == 256: code_string = ''.join([chr(x) for x in range(256)])
    else: raise ValueError("Invalid base!")
+   _code_strings[base] = code_string
+   return code_string
 
 def encode(val,base,minlen=0):
    code_string = get_code_string(base)
@@ -63,7 +71,7 @@ def base10_add(a,b):
   if isinf(a): return b[0],b[1]
   if isinf(b): return a[0],a[1]
   if a[0] == b[0]:
-    if a[1] == b[1]: return base10_double(a[0],a[1])
+    if a[1] == b[1]: return base10_double(a)
     else: return (0,0)
   m = ((b[1]-a[1]) * inv(b[0]-a[0],P)) % P
   x = (m*m-a[0]-b[0]) % P
@@ -84,6 +92,33 @@ def base10_multiply(a,n):
   if (n%2) == 0: return base10_double(base10_multiply(a,n/2))
   if (n%2) == 1: return base10_add(base10_double(base10_multiply(a,n/2)),a)
 
+# Fixed-base multiplication by G using a table of j*16^i*G, built on first use
+
+_G_table = None
+
+def get_G_table():
+  global _G_table
+  if _G_table is None:
+    table, base = [], G
+    for i in range(64):
+      row = [(0,0), base, base10_double(base)]
+      for j in range(3,16): row.append(base10_add(row[j-1],base))
+      table.append(row)
+      base = base10_double(row[8])
+    _G_table = table
+  return _G_table
+
+def base10_multiply_G(n):
+  n = n % N
+  table = get_G_table()
+  result = (0,0)
+  i = 0
+  while n > 0:
+    if n & 15: result = base10_add(result,table[i][n & 15])
+    n >>= 4
+    i += 1
+  return result
+
 def hex_to_point(h): return (decode(h[2:66],16),decode(h[66:],16))
 def point_to_hex(p): return '04'+encode(p[0],16,64)+encode(p[1],16,64)
 
@@ -272,55 +307,121 @@ def ecdsa_verify_with_address(msg,sig,addr,magicbytes=0):
 
 ### Electrum wallets
 
-def electrum_stretch(seed): return slowsha(seed)
+# Stretching is 100k sha256 rounds, so recently stretched seeds are remembered
+
+_stretch_cache = {}
+STRETCH_CACHE_SIZE = 256
+
+def electrum_stretch(seed):
+    stretched = _stretch_cache.get(seed)
+    if stretched is None:
+        stretched = slowsha(seed)
+        if len(_stretch_cache) >= STRETCH_CACHE_SIZE: _stretch_cache.clear()
+        _stretch_cache[seed] = stretched
+    return stretched
 
 # Accepts seed or stretched seed, returns master public key
 def electrum_mpk(seed):
     if len(seed) == 32: seed = electrum_stretch(seed)
     return privtopub(seed)[2:]
 
+# Accepts master public key and index, returns the offset added to the seed/mpk
+def electrum_offset(mpk,n,for_change=0):
+    return decode(bin_dbl_sha256("%d:%d:"%(n,for_change)+mpk.decode('hex')),256)
+
 # Accepts (seed or stretched seed) and index, returns privkey
 def electrum_privkey(seed,n,for_change=0):
     if len(seed) == 32: seed = electrum_stretch(seed)
     mpk = electrum_mpk(seed)
-    offset = decode(bin_dbl_sha256("%d:%d:"%(n,for_change)+mpk.decode('hex')),256)
-    return encode((decode(seed,16) + offset) % N,16,64)
+    return encode((decode(seed,16) + electrum_offset(mpk,n,for_change)) % N,16,64)
+
+# Accepts (seed or stretched seed or master public key), returns master public key
+def electrum_masterkey_to_mpk(masterkey):
+    if len(masterkey) == 32: return electrum_mpk(electrum_stretch(masterkey))
+    elif len(masterkey) == 64: return electrum_mpk(masterkey)
+    else: return masterkey
 
 # Accepts (seed or stretched seed or master public key) and index, returns pubkey
 def electrum_pubkey(masterkey,n,for_change=0):
-    if len(masterkey) == 32: mpk = electrum_mpk(electrum_stretch(masterkey))
-    elif len(masterkey) == 64: mpk = electrum_mpk(masterkey)
-    else: mpk = masterkey
-    offset = decode(bin_dbl_sha256("%d:%d:"%(n,for_change)+mpk.decode('hex')),256)
-    return add('04'+mpk,point_to_hex(multiply(G,offset)))
-
-funs = {
-    "pubkey_to_address": pubkey_to_address,
-    "privtopub": privtopub,
-    "add": add,
-    "multiply": multiply,
-    "bin_to_b58check": bin_to_b58check,
-    "b58check_to_bin": b58check_to_bin,
-    "hex_to_b58check": hex_to_b58check,
-    "b58check_to_hex": b58check_to_hex,
-    "sha256": sha256,
-    "hash160": hash160,
-    "compress": compress,
-    "decompress": decompress,
-    "encode_sig": encode_sig,
-    "decode_sig": decode_sig,
-    "sign": ecdsa_sign,
-    "verifypub": ecdsa_verify,
-    "sigpubkey": ecdsa_recover,
-    "sigaddr": ecdsa_recover_to_address,
-    "verify": ecdsa_verify_with_address,
-    "electrum_stretch": electrum_stretch,
-    "electrum_mpk": electrum_mpk,
-    "electrum_privkey": electrum_privkey,
-    "electrum_pubkey": electrum_pubkey,
-}
-if len(sys.argv) > 1:
-    f = funs.get(sys.argv[1],None)
+    mpk = electrum_masterkey_to_mpk(masterkey)
+    offset = electrum_offset(mpk,n,for_change)
+    return point_to_hex(base10_add(hex_to_point('04'+mpk),base10_multiply_G(offset)))
+
+# Bulk derivation: the seed is stretched and the mpk computed once for the whole range
+
+def electrum_privkey_range(seed,start,count,for_change=0):
+    if len(seed) == 32: seed = electrum_stretch(seed)
+    mpk = electrum_mpk(seed)
+    secret = decode(seed,16)
+    return [encode((secret + electrum_offset(mpk,n,for_change)) % N,16,64)
+            for n in range(start,start+count)]
+
+def _electrum_pubkey_chunk(args):
+    mpk, indices, for_change = args
+    mpk_point = hex_to_point('04'+mpk)
+    return [point_to_hex(base10_add(mpk_point,base10_multiply_G(electrum_offset(mpk,n,for_change))))
+            for n in indices]
+
+# Accepts (seed or stretched seed or master public key), returns pubkeys start..start+count-1.
+# processes=None uses one process per cpu, processes=1 derives in this process.
+def electrum_pubkey_range(masterkey,start,count,for_change=0,processes=None):
+    mpk = electrum_masterkey_to_mpk(masterkey)
+    indices = range(start,start+count)
+    # Build the G table before forking so every worker inherits it
+    get_G_table()
+    if processes == 1 or count < 2:
+        return _electrum_pubkey_chunk((mpk,indices,for_change))
+    import multiprocessing
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        size = max(1,-(-count // (processes * 4)))
+        chunks = pool.map(_electrum_pubkey_chunk,
+                          [(mpk,indices[i:i+size],for_change) for i in range(0,count,size)])
+    finally:
+        pool.close()
+        pool.join()
+    return [pub for chunk in chunks for pub in chunk]
+
+### Command line interface, only used when run as a script: python pybitcointools.py <function> <args...>
+
+def cli_functions():
+  return {
+      "pubkey_to_address": pubkey_to_address,
+      "privtopub": privtopub,
+      "add": add,
+      "multiply": multiply,
+      "bin_to_b58check": bin_to_b58check,
+      "b58check_to_bin": b58check_to_bin,
+      "hex_to_b58check": hex_to_b58check,
+      "b58check_to_hex": b58check_to_hex,
+      "sha256": sha256,
+      "hash160": hash160,
+      "compress": compress,
+      "decompress": decompress,
+      "encode_sig": encode_sig,
+      "decode_sig": decode_sig,
+      "sign": ecdsa_sign,
+      "verifypub": ecdsa_verify,
+      "sigpubkey": ecdsa_recover,
+      "sigaddr": ecdsa_recover_to_address,
+      "verify": ecdsa_verify_with_address,
+      "electrum_stretch": electrum_stretch,
+      "electrum_mpk": electrum_mpk,
+      "electrum_privkey": electrum_privkey,
+      "electrum_pubkey": electrum_pubkey,
+  }
+
+def main(argv):
+    if len(argv) < 2:
+        sys.stderr.write("Usage: pybitcointools.py <function> [args...]\n")
+        return 1
+    f = cli_functions().get(argv[1],None)
     if not f:
-        if sys.argv[0] != 'test.py': sys.stderr.write( "Invalid argument" )
-    else: print f(*sys.argv[2:])
+        sys.stderr.write("Invalid argument\n")
+        return 1
+    print f(*argv[2:])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,211 @@
+"""
+servicepool - Serve ServiceAgent calls with a pool of worker processes.
+
+ServiceAgent.work runs every service in the polling interpreter, so CPU-heavy
+services are limited by the GIL. A ServicePool keeps the polling in one process
+and forks worker processes that run the services:
+
+    pool = ServicePool(agent, processes=4)
+    pool.start()
+    while True:
+        pool.work()
+
+The poller fetches calls as ServiceAgent.work does, hands them to the workers
+and posts the replies, refunds and lastread placeholder in call order once every
+call is served, so replies and lastread semantics are the same as work's.
+
+Python 2 has no multiprocessing.shared_memory, so call bodies and replies larger
+than shm_threshold go through files in /dev/shm (a tmpfs) instead of being
+pickled through the task queues.
+
+A worker that dies is restarted, and the calls it was given are handed to the
+new worker. A call that was being served by max_attempts workers that all died
+gets an error reply and a refund, like a service that raised.
+
+Workers are forked from the poller, so services must be registered before start.
+Metrics recorded while signing replies in a worker stay in that worker.
+"""
+
+import os
+import Queue
+import tempfile
+import itertools
+import traceback
+import multiprocessing
+
+DEFAULT_SHM_THRESHOLD = 64 * 1024
+DEFAULT_MAX_ATTEMPTS = 3
+POLL_INTERVAL = 0.1
+
+_BODY = 5
+
+
+def default_shm_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _write_shared(directory, data):
+    fd, path = tempfile.mkstemp(prefix="netvend-", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _read_shared(path, remove=False):
+    with open(path, "rb") as f:
+        data = f.read()
+    if remove:
+        os.remove(path)
+    return data
+
+
+def _worker_loop(agent, tasks, results, current, shm_dir, shm_threshold):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, call, body_path = task
+        current.value = task_id
+        try:
+            if body_path is not None:
+                call = call[:_BODY] + [_read_shared(body_path)]
+            return_str, refund = agent.serve_call(call)
+            return_path = None
+            if return_str is not None and len(return_str) >= shm_threshold:
+                return_path = _write_shared(shm_dir, return_str)
+                return_str = None
+            results.put((task_id, return_str, return_path, refund, None))
+        except Exception:
+            # Only reached with raise_error_local, serve_call handles service errors otherwise
+            results.put((task_id, None, None, None, traceback.format_exc()))
+        current.value = -1
+
+
+class _Worker(object):
+    def __init__(self, pool):
+        self.tasks = multiprocessing.Queue()
+        self.current = multiprocessing.Value("l", -1, lock=False)
+        self.assigned = set()
+        self.process = multiprocessing.Process(target=_worker_loop,
+                                               args=(pool.agent, self.tasks, pool.results, self.current,
+                                                     pool.shm_dir, pool.shm_threshold))
+        self.process.daemon = True
+        self.process.start()
+
+
+class ServicePool(object):
+    """Worker processes serving the calls fetched by a ServiceAgent.
+
+    :param agent: ServiceAgent with its services registered
+    :param processes: number of workers, defaults to the number of CPUs
+    :param shm_threshold: size from which call bodies and replies are passed through shm_dir
+    :param max_attempts: workers that may die serving a call before it is answered with an error
+    :param shm_dir: directory for large payloads, defaults to /dev/shm
+    """
+    def __init__(self, agent, processes=None, shm_threshold=DEFAULT_SHM_THRESHOLD,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, shm_dir=None):
+        self.agent = agent
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shm_threshold = shm_threshold
+        self.max_attempts = max_attempts
+        self.shm_dir = shm_dir or default_shm_dir()
+        self.results = None
+        self.workers = []
+        self.task_ids = itertools.count()
+        self.restarts = 0
+
+    def start(self):
+        if not self.agent.services:
+            raise RuntimeError("Need to register services before ServicePool can start")
+        if self.workers:
+            raise RuntimeError("ServicePool already started")
+        self.results = multiprocessing.Queue()
+        self.workers = [_Worker(self) for _ in range(self.processes)]
+
+    def stop(self, timeout=5):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.tasks.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.workers = []
+
+    def work(self):
+        """Serves every new call with the workers, like ServiceAgent.work.
+
+        :return: [post batch result, pulse batch result], each None if not sent
+        """
+        if not self.workers:
+            raise RuntimeError("Need to start ServicePool before it can work")
+        self.agent.clear_batches()
+        rows, calls, outcomes = self.agent.fetch_calls()
+        to_serve = [i for i, outcome in enumerate(outcomes) if outcome is None]
+        for i, outcome in zip(to_serve, self.serve_calls([calls[i] for i in to_serve])):
+            outcomes[i] = outcome
+        return self.agent.post_results(rows, calls, outcomes)
+
+    def serve_calls(self, calls):
+        """Serves calls with the workers.
+
+        :return: the serve_call outcome of each call, in order
+        """
+        pending = {}
+        body_paths = {}
+        attempts = {}
+        try:
+            for i, call in enumerate(calls):
+                task_id = next(self.task_ids)
+                body_path = None
+                if len(call[_BODY]) >= self.shm_threshold:
+                    body_path = _write_shared(self.shm_dir, call[_BODY])
+                    body_paths[task_id] = body_path
+                pending[task_id] = (i, call[:_BODY] + [None] if body_path else call, body_path)
+                attempts[task_id] = 0
+                self._assign(self.workers[i % len(self.workers)], task_id, pending[task_id])
+
+            outcomes = [None] * len(calls)
+            while pending:
+                try:
+                    task_id, return_str, return_path, refund, error = self.results.get(timeout=POLL_INTERVAL)
+                except Queue.Empty:
+                    self._restart_dead(pending, attempts, outcomes, calls)
+                    continue
+                if return_path is not None:
+                    return_str = _read_shared(return_path, remove=True)
+                if task_id not in pending:
+                    continue  # Result of a call a dead worker had already answered
+                if error is not None:
+                    raise RuntimeError("service call failed in worker:\n" + error)
+                outcomes[pending.pop(task_id)[0]] = (return_str, refund)
+                for worker in self.workers:
+                    worker.assigned.discard(task_id)
+            return outcomes
+        finally:
+            for path in body_paths.values():
+                os.remove(path)
+
+    def _assign(self, worker, task_id, task):
+        worker.assigned.add(task_id)
+        worker.tasks.put((task_id,) + task[1:])
+
+    def _restart_dead(self, pending, attempts, outcomes, calls):
+        for n, worker in enumerate(self.workers):
+            if worker.process.is_alive():
+                continue
+            self.restarts += 1
+            replacement = _Worker(self)
+            self.workers[n] = replacement
+            for task_id in sorted(worker.assigned):
+                if task_id not in pending:
+                    continue
+                if task_id == worker.current.value:
+                    attempts[task_id] += 1
+                    if attempts[task_id] >= self.max_attempts:
+                        index = pending.pop(task_id)[0]
+                        outcomes[index] = self.agent.error_outcome(calls[index], "worker crashed")
+                        continue
+                self._assign(replacement, task_id, pending[task_id])